@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 import os
 import sys
+import cProfile
+import metrics
 from args import parse_args
-from sigma_processor import clean_chainrule_directory, process_sigma_files, print_summary
-from hayabusa_runner import run_hayabusa_command
+from sigma_processor import process_sigma_files, print_summary
+from hayabusa_runner import run_hayabusa_command, run_hayabusa_sharded
 from stix_utils import get_attack_ids_by_threat_actor
+from result_cache import run_hayabusa_cached
+from evtx_pruner import build_evtx_filter
 from lolbin_processor import process_lolbin_files, print_lolbin_summary
+from batch_processor import run_batch
 
 def print_logo():
     logo = """
@@ -24,46 +29,108 @@ def main():
     print_logo()
     args = parse_args()
 
-    # When hayabusa is used, ensure that either -d or -f is specified
-    if args.use_hayabusa:
-        if not (args.d_evtx or args.f_evtx):
-            sys.exit("Error: When using hayabusa, either -d or -f must be specified.")
+    # Instrumentation is opt-in; when off, the stage/counter hooks are no-ops
+    if args.metrics:
+        metrics.enable()
+    profiler = None
+    if args.profile_dump:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile_dump)
+            print(f"Profile written to {args.profile_dump}")
+        if args.metrics:
+            metrics.write_report(args.metrics)
 
+def select_rules(args, sigma_dir, chainrule_dir, stix_file, state=None):
+    """
+    Place the rules selected by the actor, technique, tactic, product or LOLBin options in
+    args into chainrule_dir and print their summary. state optionally supplies the actor
+    table, rule records and LOLBAS index already held in memory by the daemon.
+    Returns (tactic_to_files, unique_matched_files), or None if nothing could be selected.
+    """
     product = args.product.lower()
     tactic_filter = args.tactics.lower() if args.tactics else None
 
-    if args.lolbin:
+    if args.lolbin is not None:
         attack_ids = []
     elif args.threat_actor_name:
-        stix_file = "./mitre_data/enterprise-attack.json"  # Path to the local STIX file
-        attack_ids = get_attack_ids_by_threat_actor(stix_file, args.threat_actor_name)
+        with metrics.stage("actor_resolution"):
+            attack_ids = get_attack_ids_by_threat_actor(
+                stix_file, args.threat_actor_name, state.actor_table if state else None
+            )
         if not attack_ids:
-            sys.exit(1)
+            return None
     elif args.attackID:
         attack_ids = [aid.lower() for aid in args.attackID]
     else:
         attack_ids = []
 
-    current_dir = os.getcwd()
-    sigma_dir = os.path.join(current_dir, "hayabusa-rules", "sigma")
     if not os.path.exists(sigma_dir):
         print(f"Error: '{sigma_dir}' directory does not exist.")
-        sys.exit(1)
+        return None
 
-    # Clean up and recreate the 'chainrule' directory
+    if args.lolbin is not None:
+        with metrics.stage("lolbin_selection"):
+            tactic_to_files, unique_matched_files = process_lolbin_files(
+                chainrule_dir, args.workers, args.link_mode, args.lolbin, state.lolbas_index if state else None
+            )
+        with metrics.stage("summary"):
+            print_lolbin_summary(tactic_to_files, unique_matched_files)
+    else:
+        # The summary is driven by the manifest, which holds the tactic grouping in both layouts
+        with metrics.stage("rule_selection"):
+            tactic_to_files, unique_matched_files = process_sigma_files(
+                sigma_dir, chainrule_dir, attack_ids, product, tactic_filter, args.workers, args.dedup,
+                args.link_mode, state.candidate_records(attack_ids) if state else None, args.cost_budget
+            )
+        with metrics.stage("summary"):
+            print_summary(tactic_to_files, unique_matched_files, tactic_filter)
+    return tactic_to_files, unique_matched_files
+
+def run(args):
+    # When hayabusa is used, ensure that either -d or -f is specified
+    if args.use_hayabusa:
+        if not (args.d_evtx or args.f_evtx):
+            sys.exit("Error: When using hayabusa, either -d or -f must be specified.")
+
+    current_dir = os.getcwd()
+    sigma_dir = os.path.join(current_dir, "hayabusa-rules", "sigma")
+    stix_file = "./mitre_data/enterprise-attack.json"  # Path to the local STIX file
+
+    if args.batch:
+        if args.server:
+            sys.exit("Error: --server cannot be combined with --batch.")
+        if args.use_hayabusa:
+            sys.exit("Error: --use-hayabusa cannot be combined with --batch.")
+        if not os.path.exists(sigma_dir):
+            print(f"Error: '{sigma_dir}' directory does not exist.")
+            sys.exit(1)
+        with metrics.stage("batch"):
+            run_batch(
+                args.batch, sigma_dir, os.path.join(current_dir, args.batch_output), stix_file,
+                args.workers, args.dedup, args.link_mode
+            )
+        return
+
+    # The 'chainrule' directory is updated in place with only the rules that changed
     chainrule_dir = os.path.join(current_dir, "chainrule")
-    clean_chainrule_directory(chainrule_dir)
 
-    if args.lolbin:
+    selected = None
+    if args.server:
+        # Thin client: the daemon selects and places the rules from its warm state
+        from daemon import request_selection
+        with metrics.stage("daemon_selection"):
+            selected = request_selection(args.server, args, chainrule_dir)
+        if selected is False:
+            sys.exit(1)
+    if selected is None and select_rules(args, sigma_dir, chainrule_dir, stix_file) is None:
+        sys.exit(1)
 
-        process_lolbin_files(chainrule_dir)
-        print_lolbin_summary(chainrule_dir)
-    else:
-        tactic_to_files, unique_matched_files = process_sigma_files(
-            sigma_dir, chainrule_dir, attack_ids, product, tactic_filter
-        )
-        print_summary(tactic_to_files, unique_matched_files, tactic_filter)
-    
     # Execute the hayabusa command if the --use-hayabusa flag is set
     if args.use_hayabusa:
         evtx_flag = None
@@ -74,7 +141,54 @@ def main():
         elif args.f_evtx:
             evtx_flag = "-f"
             evtx_file = args.f_evtx
-        run_hayabusa_command(evtx_flag, evtx_file)
+        evtx_filter = None
+        if args.prune_evtx:
+            with metrics.stage("evtx_prune_setup"):
+                evtx_filter = build_evtx_filter(
+                    chainrule_dir, os.path.join(sigma_dir, "builtin"), args.workers
+                )
+        with metrics.stage("hayabusa"):
+            if args.result_cache:
+                completed = run_hayabusa_cached(
+                    evtx_flag, evtx_file, args.output, "chainrule", shard_count=args.shards,
+                    max_procs=args.max_procs, threads_per_proc=args.threads_per_proc,
+                    work_dir=os.path.join(current_dir, "hayabusa_cache_runs"), evtx_filter=evtx_filter
+                )
+            elif args.shards:
+                shards = run_hayabusa_sharded(
+                    evtx_flag, evtx_file, args.output, "chainrule", args.shards, args.max_procs,
+                    args.threads_per_proc, os.path.join(current_dir, "hayabusa_shards"),
+                    evtx_filter=evtx_filter
+                )
+                completed = bool(shards) and all(shard["status"] == "ok" for shard in shards)
+            else:
+                # The timeline is only written to a file when it is analysed afterwards
+                completed = run_hayabusa_command(
+                    evtx_flag, evtx_file, evtx_filter, os.path.join(current_dir, "hayabusa_pruned"),
+                    args.output if args.store or args.correlate else None
+                )
+
+        if args.store:
+            if completed and os.path.exists(args.output):
+                # pandas is only imported when a timeline is actually stored
+                from timeline_store import ingest_timeline, print_store_summary
+                with metrics.stage("store"):
+                    rows = ingest_timeline(args.output, args.store)
+                print(f"Ingested {rows} detection(s) from {args.output} into {args.store}")
+                print_store_summary(args.store)
+            else:
+                print(f"Error: no complete timeline to ingest into {args.store}.")
+
+        if args.correlate:
+            if completed and os.path.exists(args.output):
+                from correlation import correlate_timeline, print_correlation
+                with metrics.stage("correlate"):
+                    ranked, stats = correlate_timeline(
+                        args.output, chainrule_dir, os.path.join(sigma_dir, "builtin"), args.window, args.workers
+                    )
+                print_correlation(ranked, stats, args.window)
+            else:
+                print("Error: no complete timeline to correlate.")
 
 if __name__ == '__main__':
     main()
@@ -1,10 +1,12 @@
 import argparse
 import sys
-from rich.console import Console
-from rich.table import Table
-from rich.text import Text
 
 def display_help():
+    # rich is only needed for the help screen, so it is not imported on regular runs
+    from rich.console import Console
+    from rich.table import Table
+    from rich.text import Text
+
     console = Console()
 
     console.print(Text("ThreatStalker - Advanced Threat Hunting Tool", style="bold cyan underline"))
@@ -16,14 +18,32 @@ def display_help():
     table.add_row("--attackID, -id", "MITRE ATT&CK technique ID(s) (e.g., t1190, t1505)")
     table.add_row("--threat_actor_name, -a", "Threat Actor Name (e.g., APT29) - extracts associated techniques from the MITRE STIX data. Please see MITRE ATT&CK Groups(https://attack.mitre.org/groups/)")
     table.add_row("--tactics, -t", "Filter sigma rules by tactic tag (e.g., initial-access)")
-    table.add_row("--lolbin -l", "Enable advanced LOLBin detection filtering")
-    table.add_row("--product, -p", "[bold red]Required[/bold red] - Target product/platform (e.g., windows)")
+    table.add_row("--lolbin -l", "Enable advanced LOLBin detection filtering, optionally only for the given binaries (e.g. -l certutil mshta)")
+    table.add_row("--product, -p", "[bold red]Required[/bold red] (except with --batch) - Target product/platform (e.g., windows)")
+    table.add_row("--batch, -b", "Path to a batch manifest (YAML/JSON) of profiles; selects rules for every profile in one pass")
+    table.add_row("--batch-output", "Root directory for per-profile batch output (default: ./chainrule_batch)")
+    table.add_row("--dedup", "Write each selected rule once instead of once per tactic; the tactic grouping is kept in chainrule_manifest.json")
+    table.add_row("--link-mode", "How rules are placed in chainrule: hardlink (default), symlink or copy; falls back to copy when linking fails")
+    table.add_row("--cost-budget", "Cap the total estimated evaluation cost of the selected rules, keeping as many techniques covered as possible; kept and dropped techniques are reported")
+    table.add_row("--workers, -w", "Number of processes used to parse rule files (default: one per CPU)")
     table.add_row("--use-hayabusa", "Execute the hayabusa hunting tool after rule extraction")
+    table.add_row("--shards", "Split the EVTX files into N size-balanced shards and run hayabusa on them in parallel (used only with --use-hayabusa)")
+    table.add_row("--max-procs", "Maximum number of concurrent hayabusa processes in sharded mode")
+    table.add_row("--threads-per-proc", "Threads given to each hayabusa process in sharded mode")
+    table.add_row("--output, -o", "Timeline CSV written in sharded, result-cache, store or correlate mode (default: timeline.csv)")
+    table.add_row("--correlate", "Correlate the hayabusa detections per host into chains of tactics within a sliding time window")
+    table.add_row("--window", "Correlation window in minutes (default: 60)")
+    table.add_row("--store", "Ingest the hayabusa timeline into a columnar store in this directory and print per-host and top-rule counts")
+    table.add_row("--metrics", "Record per-stage time, CPU, I/O, peak RSS, cache hit rates and hayabusa runs, and write them as JSON to this file")
+    table.add_row("--profile-dump", "Write a cProfile dump of the run to this file (e.g. for snakeviz or pstats)")
+    table.add_row("--server", "URL of a running daemon (e.g. http://127.0.0.1:8765) that selects the rules from its in-memory index; falls back to a local selection when unreachable")
+    table.add_row("--result-cache", "Reuse cached hayabusa detections keyed by EVTX and rule content; only new (EVTX, rule) pairs are scanned")
+    table.add_row("--prune-evtx", "Skip EVTX files whose channel none of the selected rules can match")
     table.add_row("-d", "Path to the .evtx directory (used only with --use-hayabusa)")
     table.add_row("-f", "Path to the .evtx file (used only with --use-hayabusa)")
 
     console.print(table)
-    console.print("[bold red]Note:[/bold red] One of --threat_actor_name, --attackID, --tactics, or --lolbin must be specified.\n")
+    console.print("[bold red]Note:[/bold red] One of --threat_actor_name, --attackID, --tactics, --lolbin, or --batch must be specified.\n")
     sys.exit(0)
 
 def parse_args():
@@ -37,18 +57,47 @@ def parse_args():
     group_att.add_argument('--attackID', '-id', nargs='+', help="MITRE ATT&CK technique ID(s) (e.g., t1190, t1505)")
     group_att.add_argument('--threat_actor_name', '-a', help="Threat Actor Name (e.g., APT29) - extracts associated techniques from the MITRE STIX data. Please see MITRE ATT&CK Groups(https://attack.mitre.org/groups/)")
     parser.add_argument('--tactics', '-t', help="Filter sigma rules by tactic tag (e.g., initial-access)")
-    parser.add_argument('--lolbin', '-l', action='store_true', help="Enable advanced LOLBin detection filtering")
-    parser.add_argument('--product', '-p', required=True, help="Target product/platform (e.g., windows)")
+    parser.add_argument('--lolbin', '-l', nargs='*', metavar='BINARY', help="Enable advanced LOLBin detection filtering, optionally only for the given binaries (e.g. -l certutil mshta)")
+    parser.add_argument('--product', '-p', help="Target product/platform (e.g., windows)")
+    parser.add_argument('--batch', '-b', help="Path to a batch manifest (YAML/JSON) of profiles; selects rules for every profile in one pass")
+    parser.add_argument('--batch-output', default="chainrule_batch", help="Root directory for per-profile batch output (default: ./chainrule_batch)")
+    parser.add_argument('--dedup', action='store_true', help="Write each selected rule once instead of once per tactic; the tactic grouping is kept in chainrule_manifest.json")
+    parser.add_argument('--link-mode', choices=["hardlink", "symlink", "copy"], default="hardlink", help="How rules are placed in chainrule: hardlink (default), symlink or copy; falls back to copy when linking fails")
+    parser.add_argument('--cost-budget', type=float, help="Cap the total estimated evaluation cost of the selected rules, keeping as many techniques covered as possible; kept and dropped techniques are reported")
+    parser.add_argument('--workers', '-w', type=int, help="Number of processes used to parse rule files (default: one per CPU)")
     parser.add_argument('--use-hayabusa', action='store_true', help="Execute the hayabusa hunting tool after rule extraction")
 
+    parser.add_argument('--shards', type=int, help="Split the EVTX files into N size-balanced shards and run hayabusa on them in parallel (used only with --use-hayabusa)")
+    parser.add_argument('--max-procs', type=int, help="Maximum number of concurrent hayabusa processes in sharded mode")
+    parser.add_argument('--threads-per-proc', type=int, help="Threads given to each hayabusa process in sharded mode")
+    parser.add_argument('--output', '-o', default="timeline.csv", help="Timeline CSV written in sharded, result-cache, store or correlate mode (default: timeline.csv)")
+    parser.add_argument('--correlate', action='store_true', help="Correlate the hayabusa detections per host into chains of tactics within a sliding time window")
+    parser.add_argument('--window', type=int, default=60, help="Correlation window in minutes (default: 60)")
+    parser.add_argument('--store', help="Ingest the hayabusa timeline into a columnar store in this directory and print per-host and top-rule counts")
+    parser.add_argument('--prune-evtx', action='store_true', help="Skip EVTX files whose channel none of the selected rules can match")
+    parser.add_argument('--metrics', help="Record per-stage time, CPU, I/O, peak RSS, cache hit rates and hayabusa runs, and write them as JSON to this file")
+    parser.add_argument('--profile-dump', help="Write a cProfile dump of the run to this file (e.g. for snakeviz or pstats)")
+    parser.add_argument('--server', help="URL of a running daemon (e.g. http://127.0.0.1:8765) that selects the rules from its in-memory index; falls back to a local selection when unreachable")
+    parser.add_argument('--result-cache', action='store_true', help="Reuse cached hayabusa detections keyed by EVTX and rule content; only new (EVTX, rule) pairs are scanned")
+
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-d", dest="d_evtx", help="Path to the .evtx directory (used only with --use-hayabusa)")
     group.add_argument("-f", dest="f_evtx", help="Path to the .evtx file (used only with --use-hayabusa)")
 
     args = parser.parse_args()
 
-    if not (args.threat_actor_name or args.attackID or args.tactics or args.lolbin):
-        Console().print("[bold red]Error:[/bold red] One of --threat_actor_name, --attackID, --tactics, or --lolbin must be specified.\n", style="bold red")
+    if not (args.threat_actor_name or args.attackID or args.tactics or args.lolbin is not None or args.batch):
+        from rich.console import Console
+        Console().print("[bold red]Error:[/bold red] One of --threat_actor_name, --attackID, --tactics, --lolbin, or --batch must be specified.\n", style="bold red")
         display_help()
 
+    if args.cost_budget is not None and args.cost_budget <= 0:
+        parser.error("--cost-budget must be greater than 0")
+    if args.cost_budget is not None and (args.lolbin is not None or args.batch):
+        parser.error("--cost-budget cannot be combined with --lolbin or --batch")
+
+    # The product comes from each profile in batch mode
+    if not args.batch and not args.product:
+        parser.error("the following arguments are required: --product/-p")
+
     return args
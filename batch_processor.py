@@ -0,0 +1,164 @@
+import os
+import re
+import json
+from yaml_loader import load_yaml_file
+from rule_index import TechniqueMatcher
+from materializer import check_output_dir
+from sigma_processor import CHAINRULE_MANIFEST, discover_rule_records, match_rule_tactics, materialize_selection, print_summary
+from stix_utils import get_attack_ids_by_threat_actor
+
+def load_manifest(manifest_path):
+    """
+    Read a batch manifest and return its list of profiles.
+
+    The manifest is a YAML (or JSON) document, either a list of profiles or a mapping with
+    a 'profiles' list. Each profile accepts:
+
+      name               - required, also the name of the profile's output directory
+      product            - required, target product/platform (e.g., windows)
+      threat_actor_name  - threat actor whose techniques are selected (e.g., APT29)
+      attackID           - list of ATT&CK technique IDs (e.g., [t1190, t1505])
+      tactics            - optional tactic filter (e.g., initial-access)
+      output             - optional output directory below the output root, relative to it
+                           (default: <output root>/<name>)
+
+    Invalid profiles are reported and skipped.
+    """
+    try:
+        data = load_yaml_file(manifest_path)
+    except Exception as e:
+        print(f"Error reading manifest {manifest_path}: {e}")
+        return []
+    if isinstance(data, dict):
+        data = data.get("profiles")
+    if not isinstance(data, list):
+        print(f"Error: manifest {manifest_path} does not contain a list of profiles.")
+        return []
+
+    profiles = []
+    seen_names = set()
+    for i, entry in enumerate(data):
+        if not isinstance(entry, dict):
+            print(f"Error: profile #{i + 1} is not a mapping; skipped.")
+            continue
+        name = str(entry.get("name") or "").strip()
+        product = entry.get("product")
+        if not name or not re.match(r"^[\w.-]+$", name):
+            print(f"Error: profile #{i + 1} needs a 'name' made of letters, digits, '.', '_' or '-'; skipped.")
+            continue
+        if name in seen_names:
+            print(f"Error: duplicate profile name '{name}'; skipped.")
+            continue
+        if not isinstance(product, str):
+            print(f"Error: profile '{name}' needs a 'product'; skipped.")
+            continue
+        attack_ids = entry.get("attackID") or []
+        if isinstance(attack_ids, str):
+            attack_ids = attack_ids.split()
+        tactics = entry.get("tactics")
+        output = entry.get("output")
+        if output is not None and not isinstance(output, str):
+            print(f"Error: profile '{name}' has a non-string 'output'; skipped.")
+            continue
+        if not (entry.get("threat_actor_name") or attack_ids or tactics):
+            print(f"Error: profile '{name}' needs one of threat_actor_name, attackID or tactics; skipped.")
+            continue
+        seen_names.add(name)
+        profiles.append({
+            "name": name,
+            "product": product.lower(),
+            "threat_actor_name": entry.get("threat_actor_name"),
+            "attack_ids": [str(aid).lower() for aid in attack_ids],
+            "tactic_filter": tactics.lower() if isinstance(tactics, str) else None,
+            "output": output,
+        })
+    return profiles
+
+def build_profile_summary(profile, tactic_to_files, unique_matched_files):
+    """
+    Return the summary.json content describing the rules materialized for a profile.
+    """
+    summary = {
+        "name": profile["name"],
+        "product": profile["product"],
+        "threat_actor_name": profile["threat_actor_name"],
+        "attack_ids": profile["resolved_ids"],
+        "tactic_filter": profile["tactic_filter"],
+        "tactics": {tactic: len(files) for tactic, files in sorted(tactic_to_files.items())},
+        "total_unique_rules": len(unique_matched_files),
+    }
+    return json.dumps(summary, indent=2)
+
+def resolve_profile_output(profile, output_root):
+    """
+    Return the output directory of a profile. Since it is replaced wholesale, it must lie
+    below output_root and must not be an existing directory written by something else;
+    a ValueError is raised otherwise.
+    """
+    output_dir = os.path.normpath(os.path.join(output_root, profile["output"] or profile["name"]))
+    # The output itself is a symlink to its current version, so only its parent is resolved
+    resolved = os.path.join(os.path.realpath(os.path.dirname(output_dir)), os.path.basename(output_dir))
+    root = os.path.realpath(output_root)
+    if resolved == root or os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f"'{output_dir}' is outside the batch output directory {output_root}")
+    check_output_dir(output_dir, CHAINRULE_MANIFEST)
+    return output_dir
+
+def run_batch(manifest_path, sigma_dir, output_root, stix_file, workers=None, dedup=False, link_mode="hardlink"):
+    """
+    Select rules for every profile in the manifest with a single pass over the rule corpus,
+    then materialize each profile into its own output directory with its own manifest
+    and summary.
+    """
+    profiles = load_manifest(manifest_path)
+    if not profiles:
+        print("No valid profiles in the batch manifest.")
+        return
+
+    sigma_builtin_dir = os.path.join(sigma_dir, "builtin")
+    if not os.path.exists(sigma_builtin_dir):
+        print(f"Error: '{sigma_builtin_dir}' directory does not exist.")
+        return
+
+    # Resolve each profile's technique matcher up front; None means no technique filter.
+    active = []
+    union_ids = set()
+    for profile in profiles:
+        attack_ids = profile["attack_ids"]
+        if profile["threat_actor_name"]:
+            attack_ids = get_attack_ids_by_threat_actor(stix_file, profile["threat_actor_name"])
+            if not attack_ids:
+                print(f"Profile '{profile['name']}' skipped.")
+                continue
+        profile["resolved_ids"] = sorted({attack_id.lower() for attack_id in attack_ids})
+        profile["matcher"] = TechniqueMatcher(attack_ids) if attack_ids else None
+        union_ids.update(profile["resolved_ids"])
+        profile["selection"] = {}
+        active.append(profile)
+
+    # One streaming pass over the corpus, evaluating every profile against each rule. When
+    # every profile filters by technique, only the union of their postings is streamed.
+    if any(profile["matcher"] is None for profile in active):
+        union_ids = None
+    for record in discover_rule_records(sigma_dir, ["builtin"], workers, union_ids):
+        for profile in active:
+            if profile["matcher"] is not None and not profile["matcher"].matches(record["techniques"]):
+                continue
+            tactic_tags = match_rule_tactics(record, profile["product"], profile["tactic_filter"])
+            if tactic_tags is None:
+                continue
+            for tactic in tactic_tags:
+                profile["selection"].setdefault(tactic, set()).add(record["path"])
+
+    for profile in active:
+        try:
+            output_dir = resolve_profile_output(profile, output_root)
+        except ValueError as e:
+            print(f"Error: profile '{profile['name']}': {e}; skipped.")
+            continue
+        print(f"\n=== Profile: {profile['name']} -> {output_dir} ===")
+        tactic_to_files, unique_matched_files = materialize_selection(
+            output_dir, profile["selection"], dedup, link_mode,
+            lambda t, u, profile=profile: {"summary.json": build_profile_summary(profile, t, u)},
+        )
+        print_summary(tactic_to_files, unique_matched_files, profile["tactic_filter"])
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for ThreatStalker's rule selection.
+
+Generates a synthetic hayabusa-rules/LOLBAS/STIX corpus at the requested scale, times each
+selection stage cold (caches removed) and warm, and writes the results as JSON. Results
+can be compared against a stored baseline; the exit status is 1 when a stage regressed.
+
+    python3 benchmark.py --rules 20000 --output bench.json
+    python3 benchmark.py --rules 20000 --baseline bench.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import resource
+import platform
+import argparse
+import tracemalloc
+import contextlib
+
+BENCHMARK_VERSION = 1
+
+# Tactics and logsources in the shapes found in hayabusa-rules' Sigma builtin rules.
+TACTICS = [
+    "reconnaissance", "resource-development", "initial-access", "execution", "persistence",
+    "privilege-escalation", "defense-evasion", "credential-access", "discovery",
+    "lateral-movement", "collection", "command-and-control", "exfiltration", "impact",
+]
+WINDOWS_LOGSOURCES = [
+    ("category", "process_creation", "Microsoft-Windows-Sysmon/Operational", 1),
+    ("category", "network_connection", "Microsoft-Windows-Sysmon/Operational", 3),
+    ("category", "registry_set", "Microsoft-Windows-Sysmon/Operational", 13),
+    ("category", "file_event", "Microsoft-Windows-Sysmon/Operational", 11),
+    ("category", "image_load", "Microsoft-Windows-Sysmon/Operational", 7),
+    ("category", "ps_script", "Microsoft-Windows-PowerShell/Operational", 4104),
+    ("service", "security", "Security", 4624),
+    ("service", "system", "System", 7045),
+]
+PRODUCT_WEIGHTS = [("windows", 0.8), ("linux", 0.12), ("macos", 0.08)]
+LEVELS = ["informational", "low", "medium", "high", "critical"]
+TECHNIQUE_COUNT = 600
+STAGES = ["actor", "scan", "filter", "materialize", "summary", "lolbin", "catalog", "catalog_select"]
+# Fixed ceiling on the RuleCatalog's bytes per rule, checked on every run with or without a
+# baseline (about 440 bytes/rule are held at 100k rules, more on small corpora).
+CATALOG_MAX_BYTES_PER_RULE = 1024
+# (hits, window seconds, expected (breadth, progression)) for correlate_detections. The first
+# case only reaches its best score after evicting a tactic's first sighting.
+CORRELATION_RULE_TACTICS = {"e.yml": ["execution"], "i.yml": ["initial-access"]}
+CORRELATION_CASES = [
+    ([(0, "e.yml"), (2, "i.yml"), (5, "i.yml"), (8, "e.yml"), (11, "i.yml")], 10, (2, 2)),
+    ([(2, "i.yml"), (5, "i.yml"), (8, "e.yml"), (11, "i.yml")], 10, (2, 2)),
+]
+
+def _technique_ids(rng):
+    """
+    Return ATT&CK-style technique IDs, about a third of them with sub-techniques.
+    """
+    ids = []
+    for i in range(TECHNIQUE_COUNT):
+        base = f"T{1000 + i}"
+        ids.append(base)
+        if rng.random() < 0.35:
+            ids.extend(f"{base}.{sub:03d}" for sub in range(1, rng.randint(2, 6)))
+    return ids
+
+def _pick_product(rng):
+    value = rng.random()
+    for product, weight in PRODUCT_WEIGHTS:
+        if value < weight:
+            return product
+        value -= weight
+    return PRODUCT_WEIGHTS[0][0]
+
+def _rule_yaml(rng, i, technique_ids):
+    product = _pick_product(rng)
+    kind, source, channel, event_id = rng.choice(WINDOWS_LOGSOURCES)
+    tags = []
+    if rng.random() < 0.92:
+        tags.extend(f"attack.{tactic}" for tactic in rng.sample(TACTICS, rng.choice([1, 1, 1, 2, 2, 3])))
+        tags.extend(f"attack.{tech.lower()}" for tech in rng.sample(technique_ids, rng.randint(1, 3)))
+        if rng.random() < 0.1:
+            tags.append(f"attack.s{rng.randint(1, 700):04d}")
+    if rng.random() < 0.2:
+        tags.append(f"car.2016-04-{rng.randint(1, 30):03d}")
+    lines = [
+        f"title: Synthetic Rule {i}",
+        f"id: {uuid.UUID(int=rng.getrandbits(128), version=4)}",
+        f"status: {rng.choice(['stable', 'test', 'experimental'])}",
+        f"description: Detects synthetic activity pattern number {i}",
+        "author: benchmark",
+    ]
+    if tags:
+        lines.append("tags:")
+        lines.extend(f"    - {tag}" for tag in tags)
+    lines.extend([
+        "logsource:",
+        f"    product: {product}",
+        f"    {kind}: {source}",
+        "detection:",
+        "    selection:",
+        f"        Channel: {channel}",
+        f"        EventID: {event_id}",
+        f"        Image|endswith: '\\\\tool{i % 997}.exe'",
+        "        CommandLine|contains:",
+        f"            - ' -arg{i % 31} '",
+        f"            - ' /opt{i % 17}'",
+        "    condition: selection",
+        "falsepositives:",
+        "    - Unknown",
+        f"level: {rng.choice(LEVELS)}",
+    ])
+    return "\n".join(lines) + "\n"
+
+def _stix_bundle(rng, technique_ids, groups):
+    def stix_id(kind):
+        return f"{kind}--{uuid.UUID(int=rng.getrandbits(128), version=4)}"
+
+    timestamp = "2024-01-01T00:00:00.000Z"
+    objects = []
+    patterns = []
+    for attack_id in technique_ids:
+        pattern = {
+            "type": "attack-pattern", "id": stix_id("attack-pattern"), "spec_version": "2.1",
+            "created": timestamp, "modified": timestamp, "name": f"Technique {attack_id}",
+            "external_references": [{"source_name": "mitre-attack", "external_id": attack_id}],
+        }
+        if rng.random() < 0.03:
+            pattern["x_mitre_deprecated"] = True
+        patterns.append(pattern)
+    objects.extend(patterns)
+    for g in range(groups):
+        group = {
+            "type": "intrusion-set", "id": stix_id("intrusion-set"), "spec_version": "2.1",
+            "created": timestamp, "modified": timestamp, "name": f"APT{g}",
+            "aliases": [f"APT{g}", f"Synthetic Panda {g}"],
+        }
+        objects.append(group)
+        for pattern in rng.sample(patterns, rng.randint(10, 80)):
+            objects.append({
+                "type": "relationship", "id": stix_id("relationship"), "spec_version": "2.1",
+                "created": timestamp, "modified": timestamp, "relationship_type": "uses",
+                "source_ref": group["id"], "target_ref": pattern["id"],
+            })
+    return {"type": "bundle", "id": stix_id("bundle"), "objects": objects}
+
+def generate_corpus(root, rules=1000, lolbas=200, groups=50, seed=1):
+    """
+    Write a synthetic corpus below root: hayabusa-rules/sigma/builtin (rules spread over
+    logsource folders), LOLBAS/yml (entries with Detection.Sigma links to those rules) and
+    mitre_data/enterprise-attack.json (intrusion-sets with 'uses' relationships). An
+    existing corpus generated with the same parameters is reused.
+    """
+    config = {"rules": rules, "lolbas": lolbas, "groups": groups, "seed": seed}
+    marker = os.path.join(root, "corpus.json")
+    try:
+        with open(marker, "r", encoding="utf-8") as f:
+            if json.load(f) == config:
+                return config
+    except (OSError, ValueError):
+        pass
+    from materializer import remove_output
+    for sub in ("hayabusa-rules", "LOLBAS", "mitre_data", "cache"):
+        shutil.rmtree(os.path.join(root, sub), ignore_errors=True)
+    for sub in ("chainrule", "chainrule_lolbin"):
+        remove_output(os.path.join(root, sub))
+
+    rng = random.Random(seed)
+    technique_ids = _technique_ids(rng)
+    builtin_dir = os.path.join(root, "hayabusa-rules", "sigma", "builtin")
+    rule_names = []
+    for i in range(rules):
+        folder = os.path.join(builtin_dir, rng.choice(["windows", "windows", "windows", "linux", "macos"]),
+                              rng.choice(WINDOWS_LOGSOURCES)[1])
+        os.makedirs(folder, exist_ok=True)
+        name = f"synthetic_rule_{i:06d}.yml"
+        with open(os.path.join(folder, name), "w", encoding="utf-8") as f:
+            f.write(_rule_yaml(rng, i, technique_ids))
+        rule_names.append(name)
+
+    lolbas_dir = os.path.join(root, "LOLBAS", "yml", "OSBinaries")
+    os.makedirs(lolbas_dir, exist_ok=True)
+    for i in range(lolbas):
+        lines = [f"Name: Binary{i}.exe", f"Description: Synthetic LOLBIN {i}", "Detection:"]
+        for name in rng.sample(rule_names, min(len(rule_names), rng.randint(1, 4))):
+            lines.append(f"  - Sigma: https://github.com/SigmaHQ/sigma/blob/master/rules/windows/{name}")
+        if rng.random() < 0.1:
+            lines.append("  - Sigma: https://github.com/SigmaHQ/sigma/blob/master/rules/windows/missing_rule.yml")
+        lines.append(f"  - IOC: binary{i}.exe spawned from an unusual parent")
+        with open(os.path.join(lolbas_dir, f"Binary{i}.yml"), "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    os.makedirs(os.path.join(root, "mitre_data"), exist_ok=True)
+    with open(os.path.join(root, "mitre_data", "enterprise-attack.json"), "w", encoding="utf-8") as f:
+        json.dump(_stix_bundle(rng, technique_ids, groups), f)
+
+    with open(marker, "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    return config
+
+def _peak_rss_kb():
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children)
+
+def _run_stage(results, stage, mode, func, trace_memory=False):
+    """
+    Run one stage with its output silenced, recording wall time (and, with trace_memory,
+    the peak of Python allocations made during the stage).
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        value = func()
+    elapsed = time.perf_counter() - start
+    entry = results.setdefault(stage, {})
+    entry[mode] = min(elapsed, entry.get(mode, float("inf")))
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        entry[f"{mode}_peak_kb"] = max(peak // 1024, entry.get(f"{mode}_peak_kb", 0))
+    return value
+
+def run_benchmark(root, actor="APT1", product="windows", workers=None, repeat=1, trace_memory=False):
+    """
+    Time each selection stage against the corpus in root, cold then warm, keeping the best
+    of `repeat` runs. Returns {stage: {'cold': seconds, 'warm': seconds, ...}} and counts,
+    which include the RuleCatalog footprint and whether its selection matches the pipeline's.
+    """
+    # Imported here so the harness measures the modules of the tree it is run from.
+    from stix_utils import get_attack_ids_by_threat_actor
+    from sigma_processor import (
+        discover_rule_records, filter_rule_records, collect_selection, materialize_selection, print_summary,
+    )
+    from lolbin_processor import process_lolbin_files, print_lolbin_summary
+    from rule_catalog import RuleCatalog
+    from materializer import remove_output
+
+    previous_dir = os.getcwd()
+    os.chdir(root)
+    try:
+        sigma_dir = os.path.join(root, "hayabusa-rules", "sigma")
+        chainrule_dir = os.path.join(root, "chainrule")
+        lolbin_dir = os.path.join(root, "chainrule_lolbin")
+        stix_file = os.path.join(root, "mitre_data", "enterprise-attack.json")
+        timings = {}
+        counts = {}
+        for _ in range(repeat):
+            for mode in ("cold", "warm"):
+                if mode == "cold":
+                    shutil.rmtree(os.path.join(root, "cache"), ignore_errors=True)
+                    remove_output(chainrule_dir)
+                    remove_output(lolbin_dir)
+                attack_ids = _run_stage(timings, "actor", mode, lambda: [
+                    aid.lower() for aid in get_attack_ids_by_threat_actor(stix_file, actor)
+                ], trace_memory)
+                records = _run_stage(timings, "scan", mode, lambda: list(
+                    discover_rule_records(sigma_dir, ["builtin"], workers)
+                ), trace_memory)
+                selection = _run_stage(timings, "filter", mode, lambda: collect_selection(
+                    filter_rule_records(records, attack_ids, product)
+                ), trace_memory)
+                tactic_to_files, unique = _run_stage(timings, "materialize", mode, lambda: materialize_selection(
+                    chainrule_dir, selection
+                ), trace_memory)
+                lolbin_tactics, lolbin_unique = _run_stage(timings, "lolbin", mode, lambda: process_lolbin_files(
+                    lolbin_dir, workers
+                ), trace_memory)
+                _run_stage(timings, "summary", mode, lambda: (
+                    print_summary(tactic_to_files, unique), print_lolbin_summary(lolbin_tactics, lolbin_unique)
+                ), trace_memory)
+                catalog = _run_stage(timings, "catalog", mode, lambda: RuleCatalog.load(root, workers), trace_memory)
+                catalog_selection = _run_stage(timings, "catalog_select", mode, lambda: catalog.select(
+                    product, actor=actor
+                ), trace_memory)
+                footprint = catalog.footprint()
+                counts = {
+                    "rules": len(records), "attack_ids": len(attack_ids),
+                    "selected": len(unique), "lolbin_selected": len(lolbin_unique),
+                    "catalog_bytes": footprint,
+                    "catalog_bytes_per_rule": round(footprint / len(catalog), 1) if len(catalog) else 0,
+                    "catalog_matches_pipeline": {
+                        tactic: {rule.path for rule in rules} for tactic, rules in catalog_selection.items()
+                    } == selection and {rule.path for rule in catalog.by_lolbin()} == lolbin_unique,
+                }
+                del catalog, catalog_selection
+        return timings, counts
+    finally:
+        os.chdir(previous_dir)
+
+def check_correlation():
+    """
+    Return a message for every CORRELATION_CASES sequence whose best chain is not scored
+    as expected.
+    """
+    from correlation import correlate_detections
+
+    failures = []
+    for hits, window, expected in CORRELATION_CASES:
+        chains, _ = correlate_detections([(ts, "host", rule) for ts, rule in hits], CORRELATION_RULE_TACTICS, window)
+        actual = (chains["host"]["breadth"], chains["host"]["progression"])
+        if actual != expected:
+            failures.append(f"{hits} (window {window}s): (breadth, progression) {actual} vs expected {expected}")
+    return failures
+
+def compare_results(results, baseline, tolerance=0.25, min_delta=0.05):
+    """
+    Return a list of regression messages: stages whose time grew by more than tolerance
+    (a fraction) and by at least min_delta seconds over the baseline, and growth of peak
+    RSS or of the RuleCatalog's bytes per rule beyond tolerance.
+    """
+    regressions = []
+    for stage, modes in baseline.get("stages", {}).items():
+        for mode, expected in modes.items():
+            if mode.endswith("_peak_kb"):
+                continue
+            actual = results["stages"].get(stage, {}).get(mode)
+            if actual is None:
+                continue
+            if actual > expected * (1 + tolerance) and actual - expected >= min_delta:
+                regressions.append(f"{stage} ({mode}): {actual:.3f}s vs baseline {expected:.3f}s")
+    expected_per_rule = baseline.get("counts", {}).get("catalog_bytes_per_rule")
+    actual_per_rule = results["counts"].get("catalog_bytes_per_rule")
+    if expected_per_rule and actual_per_rule and actual_per_rule > expected_per_rule * (1 + tolerance):
+        regressions.append(f"catalog: {actual_per_rule} bytes/rule vs baseline {expected_per_rule} bytes/rule")
+    expected_rss = baseline.get("memory", {}).get("peak_rss_kb")
+    actual_rss = results["memory"]["peak_rss_kb"]
+    if expected_rss and actual_rss > expected_rss * (1 + tolerance):
+        regressions.append(f"peak RSS: {actual_rss} KiB vs baseline {expected_rss} KiB")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ThreatStalker rule selection on a synthetic corpus")
+    parser.add_argument('--rules', type=int, default=1000, help="Number of synthetic Sigma rules (default: 1000)")
+    parser.add_argument('--lolbas', type=int, default=200, help="Number of synthetic LOLBAS entries (default: 200)")
+    parser.add_argument('--groups', type=int, default=50, help="Number of synthetic intrusion-sets (default: 50)")
+    parser.add_argument('--seed', type=int, default=1, help="Corpus generator seed (default: 1)")
+    parser.add_argument('--corpus', default=os.path.join("bench", "corpus"), help="Corpus directory (default: ./bench/corpus)")
+    parser.add_argument('--workers', type=int, help="Worker processes for rule parsing (default: one per CPU)")
+    parser.add_argument('--repeat', type=int, default=1, help="Keep the best of this many runs (default: 1)")
+    parser.add_argument('--trace-memory', action='store_true', help="Record each stage's peak Python allocations (slows stages down)")
+    parser.add_argument('--output', '-o', help="Write results as JSON to this file")
+    parser.add_argument('--baseline', help="Compare against results stored in this JSON file and fail on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed slowdown as a fraction of the baseline (default: 0.25)")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    root = os.path.abspath(args.corpus)
+    os.makedirs(root, exist_ok=True)
+    start = time.perf_counter()
+    config = generate_corpus(root, args.rules, args.lolbas, args.groups, args.seed)
+    print(f"Corpus ready in {time.perf_counter() - start:.1f}s: {root}")
+
+    timings, counts = run_benchmark(root, workers=args.workers, repeat=args.repeat, trace_memory=args.trace_memory)
+    results = {
+        "version": BENCHMARK_VERSION,
+        "corpus": config,
+        "options": {"workers": args.workers, "repeat": args.repeat, "trace_memory": args.trace_memory},
+        "environment": {
+            "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+        },
+        "stages": {stage: timings[stage] for stage in STAGES},
+        "memory": {"peak_rss_kb": _peak_rss_kb()},
+        "counts": counts,
+    }
+
+    print(f"\n{'stage':<16}{'cold (s)':>10}{'warm (s)':>10}")
+    for stage in STAGES:
+        print(f"{stage:<16}{timings[stage]['cold']:>10.3f}{timings[stage]['warm']:>10.3f}")
+    print(f"\npeak RSS: {results['memory']['peak_rss_kb']} KiB, counts: {counts}")
+    print(f"RuleCatalog: {counts['catalog_bytes'] / 1024:.0f} KiB for {counts['rules']} rules "
+          f"({counts['catalog_bytes_per_rule']:.0f} bytes/rule)")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if not counts["catalog_matches_pipeline"]:
+        print("Error: the RuleCatalog selection differs from the pipeline selection.")
+        sys.exit(1)
+    if counts["catalog_bytes_per_rule"] > CATALOG_MAX_BYTES_PER_RULE:
+        print(f"Error: the RuleCatalog holds {counts['catalog_bytes_per_rule']:.0f} bytes/rule, "
+              f"above the ceiling of {CATALOG_MAX_BYTES_PER_RULE}.")
+        sys.exit(1)
+    correlation_failures = check_correlation()
+    if correlation_failures:
+        print("Error: attack chain correlation scored these sequences wrongly:")
+        for failure in correlation_failures:
+            print(f"  {failure}")
+        sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("corpus") != config or baseline.get("options") != results["options"]:
+            print("Warning: the baseline was recorded with a different corpus or options.")
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo regressions against the baseline.")
+
+if __name__ == '__main__':
+    main()
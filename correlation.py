@@ -0,0 +1,192 @@
+import os
+import json
+from datetime import datetime, timezone
+from bisect import bisect_left
+from collections import deque, Counter
+from rule_index import load_rule_index, extract_rule_metadata
+from yaml_loader import load_yaml_files
+from sigma_processor import TACTIC_ORDER
+from hayabusa_runner import read_timeline
+
+TACTIC_RANK = {tactic: i for i, tactic in enumerate(TACTIC_ORDER)}
+
+def _normalize_tactics(tactics):
+    """
+    Return the kill-chain tactics among parsed attack tags (e.g. 'defense_evasion' is
+    read as 'defense-evasion'); other attack tags are dropped.
+    """
+    normalized = []
+    for tactic in tactics:
+        tactic = tactic.replace("_", "-")
+        if tactic in TACTIC_RANK and tactic not in normalized:
+            normalized.append(tactic)
+    return normalized
+
+def load_rule_tactics(chainrule_dir, sigma_builtin_dir, workers=None):
+    """
+    Return {rule file name: [tactics]} for the rules in chainrule_dir.
+
+    Tactics come from the rules' own attack tags, parsed as in process_sigma_files: rules
+    are looked up in the rule index by file name and parsed directly only when missing
+    from it (e.g. LOLBAS-selected rules from other rule trees).
+    """
+    records_by_name = {}
+    if os.path.exists(sigma_builtin_dir):
+        for record in load_rule_index(sigma_builtin_dir, workers=workers).values():
+            records_by_name[os.path.basename(record["path"])] = record
+    rule_tactics = {}
+    unindexed = []
+    for root, dirs, files in os.walk(chainrule_dir):
+        for file in files:
+            if not file.endswith(".yml") or file in rule_tactics:
+                continue
+            if file in records_by_name:
+                rule_tactics[file] = _normalize_tactics(records_by_name[file]["tactics"])
+            else:
+                unindexed.append(os.path.join(root, file))
+    for file_path, meta, error in load_yaml_files(unindexed, workers=workers, transform=extract_rule_metadata):
+        if error is not None:
+            print(f"Error reading file {file_path}: {error}")
+            continue
+        rule_tactics.setdefault(os.path.basename(file_path), _normalize_tactics(meta["tactics"]))
+    return rule_tactics
+
+def iter_timeline_detections(csv_path):
+    """
+    Yield (epoch seconds, host, rule file name) for each detection in a hayabusa CSV
+    timeline, in file order. Rows with an unparseable timestamp are skipped.
+    """
+    for (ts, seq), row in read_timeline(csv_path):
+        if ts == float("inf"):
+            continue
+        rule_file = os.path.basename(row.get("RuleFile", "").replace("\\", "/"))
+        yield ts, row.get("Computer", ""), rule_file
+
+def _progression(first_seen):
+    """
+    Length of the longest run of tactics whose first sightings follow kill-chain order.
+    """
+    tails = []
+    for tactic in sorted(first_seen, key=lambda t: (first_seen[t], TACTIC_RANK[t])):
+        rank = TACTIC_RANK[tactic]
+        i = bisect_left(tails, rank)
+        if i == len(tails):
+            tails.append(rank)
+        else:
+            tails[i] = rank
+    return len(tails)
+
+def correlate_detections(detections, rule_tactics, window_seconds=3600):
+    """
+    Find, per host, the time window with the broadest chain of tactics.
+
+    detections is an iterable of (epoch seconds, host, rule file name) sorted by time.
+    Each host keeps a ring buffer (deque) of its (time, tactic) hits inside the sliding
+    window plus a count per tactic, so every detection is appended and evicted once and
+    the number of distinct tactics in the window is known at all times. A host's buffer is
+    only scanned when its window gains a tactic or evicts a hit (which moves that tactic's
+    first sighting) and could then match or beat the best chain found so far. A window is
+    scored by its breadth (distinct tactics), with ties broken by how many of them appear
+    in kill-chain order.
+
+    Returns ({host: chain}, stats) where chain holds 'breadth', 'progression', 'start',
+    'end', 'tactics' (in order of first sighting) and 'detections' (hits in the window),
+    and stats counts processed, unmapped and out-of-order detections.
+    """
+    buffers = {}
+    counts = {}
+    best = {}
+    stats = {"detections": 0, "unmapped": 0, "out_of_order": 0}
+    last_ts = float("-inf")
+
+    for ts, host, rule_file in detections:
+        stats["detections"] += 1
+        tactics = rule_tactics.get(rule_file)
+        if not tactics:
+            stats["unmapped"] += 1
+            continue
+        if ts < last_ts:
+            # Input is expected in time order; late rows are evaluated at the current time
+            stats["out_of_order"] += 1
+            ts = last_ts
+        last_ts = ts
+
+        buffer = buffers.get(host)
+        if buffer is None:
+            buffer = buffers[host] = deque()
+            counts[host] = Counter()
+        in_window = counts[host]
+        changed = False
+        while buffer and ts - buffer[0][0] > window_seconds:
+            # The oldest hit is its tactic's first sighting, so evicting it changes the tactic
+            # set or moves that first sighting, and with it the progression
+            _, old = buffer.popleft()
+            in_window[old] -= 1
+            if not in_window[old]:
+                del in_window[old]
+            changed = True
+        for tactic in tactics:
+            buffer.append((ts, tactic))
+            changed = changed or tactic not in in_window
+            in_window[tactic] += 1
+
+        # The buffer is only scanned when the window's tactic set or first-seen order
+        # changed and could beat the host's best chain
+        current = best.get(host)
+        if current is not None and (
+            not changed or len(in_window) < current["breadth"]
+            or (len(in_window) == current["breadth"] and current["progression"] == current["breadth"])
+        ):
+            continue
+        first_seen = {}
+        for hit_ts, tactic in buffer:
+            first_seen.setdefault(tactic, hit_ts)
+        progression = _progression(first_seen)
+        if current is None or (len(in_window), progression) > (current["breadth"], current["progression"]):
+            best[host] = {
+                "breadth": len(in_window),
+                "progression": progression,
+                "start": buffer[0][0],
+                "end": ts,
+                "tactics": sorted(first_seen, key=lambda t: (first_seen[t], TACTIC_RANK[t])),
+                "detections": len(buffer),
+            }
+    return best, stats
+
+def correlate_timeline(csv_path, chainrule_dir, sigma_builtin_dir, window_minutes=60, workers=None):
+    """
+    Correlate a hayabusa CSV timeline against the tactics of the rules in chainrule_dir.
+    Returns (ranked [(host, chain)], stats), broadest chains first.
+    """
+    rule_tactics = load_rule_tactics(chainrule_dir, sigma_builtin_dir, workers)
+    chains, stats = correlate_detections(iter_timeline_detections(csv_path), rule_tactics, window_minutes * 60)
+    ranked = sorted(chains.items(), key=lambda item: (-item[1]["breadth"], -item[1]["progression"], item[0]))
+    return ranked, stats
+
+def _format_ts(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+def print_correlation(ranked, stats, window_minutes=60, min_tactics=2, output_json=None):
+    """
+    Print hosts whose best window spans at least min_tactics tactics, broadest first,
+    and optionally write all chains to output_json.
+    """
+    print(f"\nAttack chain correlation ({window_minutes} minute window, "
+          f"{stats['detections']} detection(s), {stats['unmapped']} without tactic tags):\n")
+    if stats["out_of_order"]:
+        print(f"Warning: {stats['out_of_order']} detection(s) were not in time order.")
+    shown = 0
+    for host, chain in ranked:
+        if chain["breadth"] < min_tactics:
+            continue
+        shown += 1
+        print(f"{host}: {chain['breadth']} tactics ({chain['progression']} in kill-chain order), "
+              f"{chain['detections']} hit(s) {_format_ts(chain['start'])} - {_format_ts(chain['end'])} UTC")
+        print(f"    {' -> '.join(chain['tactics'])}")
+    if not shown:
+        print(f"No host reached {min_tactics} tactics within the window.")
+    print()
+    if output_json:
+        with open(output_json, "w", encoding="utf-8") as f:
+            json.dump([{"host": host, **chain} for host, chain in ranked], f, indent=2)
+        print(f"Correlation results written to {output_json}\n")
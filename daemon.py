@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Resident rule selection service for ThreatStalker.
+
+Loads the ATT&CK actor table, the hayabusa-rules index and the LOLBAS index of a checkout
+once, refreshes them incrementally when mitre_data, hayabusa-rules or LOLBAS change, and
+answers selection requests on localhost. ThreatStalker.py acts as a thin client with
+--server, so repeated selections skip interpreter start-up, imports and index loading.
+
+    python3 daemon.py --port 8765
+    python3 ThreatStalker.py --server http://127.0.0.1:8765 -a APT29 -p windows
+"""
+import io
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import ipaddress
+import threading
+import contextlib
+import http.client
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DAEMON_VERSION = 1
+DEFAULT_PORT = 8765
+
+# Selection options forwarded by the thin client, with the CLI defaults used when absent.
+SELECTION_FIELDS = {
+    "threat_actor_name": None, "attackID": None, "tactics": None, "lolbin": None, "product": None,
+    "dedup": False, "link_mode": "hardlink", "workers": None, "cost_budget": None,
+}
+
+class DaemonState:
+    """
+    Actor table, rule index records with their technique postings and LOLBAS index of one
+    ThreatStalker checkout, held in memory. All access goes through `lock`, which also
+    serializes the selection requests.
+    """
+
+    def __init__(self, root, workers=None):
+        self.root = os.path.abspath(root)
+        self.sigma_dir = os.path.join(self.root, "hayabusa-rules", "sigma")
+        self.rules_dir = os.path.join(self.sigma_dir, "builtin")
+        self.lolbas_dir = os.path.join(self.root, "LOLBAS")
+        self.stix_file = os.path.join(self.root, "mitre_data", "enterprise-attack.json")
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.fingerprints = {}
+        self.actor_table = None
+        self.records = None
+        self.technique_index = None
+        self.lolbas_index = None
+        self.generation = 0
+        self.loaded_at = None
+
+    def _fingerprints(self):
+        from lolbas_index import fingerprint_tree
+        try:
+            st = os.stat(self.stix_file)
+            stix = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            stix = None
+        return {
+            "stix": stix,
+            "rules": fingerprint_tree(self.rules_dir),
+            "lolbas": fingerprint_tree(self.lolbas_dir),
+        }
+
+    def refresh(self):
+        """
+        Reload the sources whose files changed since the last refresh and return their names.
+        Rule files are reparsed only if they changed (see iter_rule_index), and the LOLBAS
+        index is rebuilt only if LOLBAS or the rules changed. A source that is missing is
+        left to the regular on-disk path, which reports it to the client. Call with `lock` held.
+        """
+        from stix_utils import load_actor_table
+        from sigma_processor import discover_rule_records
+        from rule_index import TechniqueIndex, index_techniques
+        from lolbas_index import load_lolbas_index
+
+        current = self._fingerprints()
+        changed = [name for name in current if name not in self.fingerprints or current[name] != self.fingerprints[name]]
+        if not changed:
+            return []
+        if "stix" in changed:
+            self.actor_table = None
+            if current["stix"] is not None:
+                try:
+                    self.actor_table = load_actor_table(self.stix_file)
+                except Exception as e:
+                    print(f"Error: Failed to read STIX file: {e}")
+        if "rules" in changed:
+            self.records = None
+            self.technique_index = None
+            if current["rules"] is not None:
+                self.records = list(discover_rule_records(self.sigma_dir, ["builtin"], self.workers))
+                self.technique_index = TechniqueIndex(index_techniques(enumerate(self.records)))
+        if "rules" in changed or "lolbas" in changed:
+            self.lolbas_index = None
+            if current["rules"] is not None and current["lolbas"] is not None:
+                self.lolbas_index = load_lolbas_index(self.lolbas_dir, self.rules_dir, workers=self.workers)
+        self.fingerprints = current
+        self.generation += 1
+        self.loaded_at = time.time()
+        return changed
+
+    def candidate_records(self, attack_ids):
+        """
+        Return the held records tagged with one of attack_ids or their sub-techniques (all
+        records when attack_ids is empty), or None if no records are loaded.
+        """
+        if self.records is None or not attack_ids:
+            return self.records
+        return [self.records[position] for position in sorted(self.technique_index.select(attack_ids))]
+
+    def status(self):
+        return {
+            "version": DAEMON_VERSION,
+            "root": self.root,
+            "generation": self.generation,
+            "loaded_at": self.loaded_at,
+            "actors": len(self.actor_table["groups"]) if self.actor_table else None,
+            "rules": len(self.records) if self.records is not None else None,
+            "lolbas_binaries": len(self.lolbas_index["binaries"]) if self.lolbas_index else None,
+        }
+
+def parse_selection_request(state, request):
+    """
+    Validate a /select request body and return (args namespace, chainrule_dir).
+    Raises ValueError with a message for the client on invalid requests.
+    """
+    from materializer import check_output_dir
+    from sigma_processor import CHAINRULE_MANIFEST
+
+    if not isinstance(request, dict):
+        raise ValueError("request body must be a JSON object")
+    fields = {name: request.get(name, default) for name, default in SELECTION_FIELDS.items()}
+    if not isinstance(fields["product"], str):
+        raise ValueError("'product' is required")
+    for name in ("threat_actor_name", "tactics"):
+        if fields[name] is not None and not isinstance(fields[name], str):
+            raise ValueError(f"'{name}' must be a string")
+    for name in ("attackID", "lolbin"):
+        value = fields[name]
+        if value is not None and not (isinstance(value, list) and all(isinstance(v, str) for v in value)):
+            raise ValueError(f"'{name}' must be a list of strings")
+    if fields["link_mode"] not in ("hardlink", "symlink", "copy"):
+        raise ValueError("'link_mode' must be hardlink, symlink or copy")
+    if fields["workers"] is not None and not isinstance(fields["workers"], int):
+        raise ValueError("'workers' must be an integer")
+    if fields["cost_budget"] is not None and (
+            not isinstance(fields["cost_budget"], (int, float)) or fields["cost_budget"] <= 0):
+        raise ValueError("'cost_budget' must be a number greater than 0")
+    fields["dedup"] = bool(fields["dedup"])
+
+    # The output directory is replaced wholesale, so the daemon only ever writes <root>/chainrule.
+    # Its parent is resolved rather than the path itself, which is a symlink to the current version.
+    chainrule_dir = request.get("chainrule_dir")
+    if not isinstance(chainrule_dir, str) or not os.path.isabs(chainrule_dir):
+        raise ValueError("'chainrule_dir' must be an absolute path")
+    chainrule_dir = os.path.normpath(chainrule_dir)
+    expected = os.path.join(os.path.realpath(state.root), "chainrule")
+    if os.path.join(os.path.realpath(os.path.dirname(chainrule_dir)), os.path.basename(chainrule_dir)) != expected:
+        raise ValueError(f"'chainrule_dir' must be {expected}")
+    check_output_dir(expected, CHAINRULE_MANIFEST)
+    return argparse.Namespace(**fields), expected
+
+def handle_selection(state, request):
+    """
+    Run a selection against the in-memory state and return the response body: 'ok',
+    the output the CLI would have printed, the tactic counts and the placed rule paths.
+    """
+    from ThreatStalker import select_rules
+
+    args, chainrule_dir = parse_selection_request(state, request)
+    # Output is captured through the process-wide sys.stdout, which the lock also protects
+    output = io.StringIO()
+    with state.lock:
+        # Pick up source changes the watcher has not seen yet, so no request is answered
+        # from a stale index
+        changed = state.refresh()
+        if changed:
+            print(f"Reloaded {', '.join(changed)} (generation {state.generation})")
+        with contextlib.redirect_stdout(output):
+            selected = select_rules(args, state.sigma_dir, chainrule_dir, state.stix_file, state)
+        generation = state.generation
+    response = {"ok": selected is not None, "output": output.getvalue(), "generation": generation}
+    if selected is not None:
+        tactic_to_files, unique_matched_files = selected
+        response["tactics"] = {tactic: len(files) for tactic, files in sorted(tactic_to_files.items())}
+        response["rules"] = sorted(unique_matched_files)
+    return response
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    """
+    GET /status reports the loaded state; POST /select runs a selection (JSON body with
+    the SELECTION_FIELDS options and the absolute 'chainrule_dir').
+    """
+    server_version = f"ThreatStalkerDaemon/{DAEMON_VERSION}"
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/status":
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        with self.server.state.lock:
+            body = self.server.state.status()
+        self._send_json(200, body)
+
+    def do_POST(self):
+        if self.path != "/select":
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"null")
+            body = handle_selection(self.server.state, request)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self._send_json(500, {"error": f"selection failed: {e}"})
+            return
+        self._send_json(200, body)
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"[{self.log_date_time_string()}] {format % args}\n")
+
+def watch_sources(state, interval, stop_event):
+    """
+    Poll the source trees every `interval` seconds and refresh the state when they change.
+    Only file metadata is read while nothing changed.
+    """
+    while not stop_event.wait(interval):
+        with state.lock:
+            try:
+                changed = state.refresh()
+            except Exception as e:
+                print(f"Error: refresh failed: {e}")
+                continue
+            if changed:
+                print(f"Reloaded {', '.join(changed)} (generation {state.generation})")
+
+def is_loopback_host(host):
+    """
+    Return True if every address host resolves to is a loopback address.
+    """
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except (OSError, UnicodeError):
+        return False
+    return bool(addresses) and all(ipaddress.ip_address(address.split("%")[0]).is_loopback for address in addresses)
+
+def serve(root, host="127.0.0.1", port=DEFAULT_PORT, interval=5.0, workers=None):
+    """
+    Load the state of the checkout at root and serve requests until interrupted. The
+    service has no authentication, so host must be a loopback address.
+    """
+    if not is_loopback_host(host):
+        raise ValueError(f"'{host}' is not a loopback address; the daemon only listens on localhost")
+    os.chdir(root)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    state = DaemonState(root, workers)
+    start = time.perf_counter()
+    with state.lock:
+        state.refresh()
+    print(f"Loaded {json.dumps(state.status())} in {time.perf_counter() - start:.2f}s")
+
+    server = ThreadingHTTPServer((host, port), DaemonHandler)
+    server.daemon_threads = True
+    server.state = state
+    stop_event = threading.Event()
+    watcher = threading.Thread(target=watch_sources, args=(state, interval, stop_event), daemon=True)
+    watcher.start()
+    print(f"Serving on http://{host}:{server.server_address[1]} (watching every {interval}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        server.server_close()
+
+def request_selection(server_url, args, chainrule_dir, timeout=300):
+    """
+    Send the selection options in args to the daemon at server_url and print its output.
+
+    Returns True if the rules were placed, False if the daemon rejected the request or
+    selected nothing, and None if the daemon could not be reached.
+    """
+    request = {name: getattr(args, name) for name in SELECTION_FIELDS}
+    request["chainrule_dir"] = os.path.abspath(chainrule_dir)
+    url = urllib.parse.urlsplit(server_url)
+    try:
+        connection = http.client.HTTPConnection(url.hostname or "127.0.0.1", url.port or DEFAULT_PORT, timeout=timeout)
+        connection.request("POST", "/select", json.dumps(request), {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        body = json.loads(response.read() or b"{}")
+        connection.close()
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        print(f"Warning: daemon at {server_url} is unreachable ({e}); selecting rules locally.")
+        return None
+    if response.status != 200:
+        print(f"Error: daemon rejected the request: {body.get('error', response.reason)}")
+        return False
+    sys.stdout.write(body["output"])
+    return body["ok"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve ThreatStalker rule selection from an in-memory index")
+    parser.add_argument('--root', default=os.getcwd(), help="ThreatStalker checkout holding hayabusa-rules, LOLBAS and mitre_data (default: current directory)")
+    parser.add_argument('--host', default="127.0.0.1", help="Loopback address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"Port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument('--interval', type=float, default=5.0, help="Seconds between checks for changed sources (default: 5)")
+    parser.add_argument('--workers', '-w', type=int, help="Worker processes for rule parsing (default: one per CPU)")
+    args = parser.parse_args()
+    if not is_loopback_host(args.host):
+        parser.error(f"--host must be a loopback address (got '{args.host}'); the daemon is unauthenticated")
+    serve(os.path.abspath(args.root), args.host, args.port, args.interval, args.workers)
+
+if __name__ == '__main__':
+    main()
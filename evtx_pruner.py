@@ -0,0 +1,192 @@
+import os
+import re
+import metrics
+from rule_index import load_rule_index, extract_rule_metadata
+from yaml_loader import load_yaml_files
+
+# Channels read by Sigma logsources that carry no explicit Channel in their detection.
+# Rules whose logsource is not listed here disable pruning, so omissions only cost speed.
+SERVICE_CHANNELS = {
+    "security": ["Security"],
+    "system": ["System"],
+    "application": ["Application"],
+    "sysmon": ["Microsoft-Windows-Sysmon/Operational"],
+    "powershell": ["Microsoft-Windows-PowerShell/Operational"],
+    "powershell-classic": ["Windows PowerShell"],
+    "taskscheduler": ["Microsoft-Windows-TaskScheduler/Operational"],
+    "wmi": ["Microsoft-Windows-WMI-Activity/Operational"],
+    "windefend": ["Microsoft-Windows-Windows Defender/Operational"],
+    "bits-client": ["Microsoft-Windows-Bits-Client/Operational"],
+    "firewall-as": ["Microsoft-Windows-Windows Firewall With Advanced Security/Firewall"],
+    "dns-server": ["DNS Server"],
+    "ntlm": ["Microsoft-Windows-NTLM/Operational"],
+    "codeintegrity-operational": ["Microsoft-Windows-CodeIntegrity/Operational"],
+    "terminalservices-localsessionmanager": ["Microsoft-Windows-TerminalServices-LocalSessionManager/Operational"],
+    "openssh": ["OpenSSH/Operational"],
+    "smbclient-security": ["Microsoft-Windows-SmbClient/Security"],
+    "msexchange-management": ["MSExchange Management"],
+}
+SYSMON = "Microsoft-Windows-Sysmon/Operational"
+CATEGORY_CHANNELS = {
+    "process_creation": [SYSMON, "Security"],
+    "network_connection": [SYSMON, "Security"],
+    "registry_add": [SYSMON, "Security"],
+    "registry_delete": [SYSMON, "Security"],
+    "registry_event": [SYSMON, "Security"],
+    "registry_set": [SYSMON, "Security"],
+    "registry_rename": [SYSMON, "Security"],
+    "file_event": [SYSMON],
+    "file_delete": [SYSMON],
+    "file_change": [SYSMON],
+    "image_load": [SYSMON],
+    "dns_query": [SYSMON],
+    "create_remote_thread": [SYSMON],
+    "process_access": [SYSMON],
+    "pipe_created": [SYSMON],
+    "wmi_event": [SYSMON],
+    "raw_access_thread": [SYSMON],
+    "create_stream_hash": [SYSMON],
+    "process_tampering": [SYSMON],
+    "ps_module": ["Microsoft-Windows-PowerShell/Operational"],
+    "ps_script": ["Microsoft-Windows-PowerShell/Operational"],
+    "ps_classic_start": ["Windows PowerShell"],
+    "ps_classic_provider_start": ["Windows PowerShell"],
+    "antivirus": ["Microsoft-Windows-Windows Defender/Operational"],
+}
+
+# An EVTX file header is followed by 64 KiB chunks; the first chunk's templates and
+# records carry the channel name as a BinXML string value (value token 0x05, string type
+# 0x01, UTF-16 character count, UTF-16LE text). Matching that prefix keeps element names
+# such as <System> or <Security> from being taken for channel names.
+EVTX_MAGIC = b"ElfFile\x00"
+EVTX_SNIFF_BYTES = 4096 + 65536
+
+def _channel_value_pattern(channel):
+    encoded = b"\x05\x01" + len(channel).to_bytes(2, "little") + channel.encode("utf-16-le")
+    return re.compile(re.escape(encoded), re.IGNORECASE)
+
+def rule_channels(record):
+    """
+    Return the set of (lowercased) channels a rule can match, or None if unknown.
+    """
+    if record.get("channels"):
+        return {channel.lower() for channel in record["channels"]}
+    logsource = record["logsource"]
+    channels = set()
+    if logsource.get("service"):
+        if logsource["service"] not in SERVICE_CHANNELS:
+            return None
+        channels.update(SERVICE_CHANNELS[logsource["service"]])
+    elif logsource.get("category"):
+        if logsource["category"] not in CATEGORY_CHANNELS:
+            return None
+        channels.update(CATEGORY_CHANNELS[logsource["category"]])
+    else:
+        return None
+    return {channel.lower() for channel in channels}
+
+def load_rules_for_pruning(rules_dir, sigma_builtin_dir, workers=None):
+    """
+    Return index records for the .yml rules in rules_dir (e.g. chainrule), looked up in the
+    rule index by file name and parsed directly only when missing from it.
+    """
+    records_by_name = {}
+    if os.path.exists(sigma_builtin_dir):
+        for record in load_rule_index(sigma_builtin_dir, workers=workers).values():
+            records_by_name[os.path.basename(record["path"])] = record
+    records = []
+    unindexed = []
+    for root, dirs, files in os.walk(rules_dir):
+        for file in files:
+            if file.endswith(".yml"):
+                if file in records_by_name:
+                    records.append(records_by_name[file])
+                else:
+                    unindexed.append(os.path.join(root, file))
+    for file_path, meta, error in load_yaml_files(unindexed, workers=workers, transform=extract_rule_metadata):
+        if error is not None:
+            print(f"Error reading file {file_path}: {error}")
+            continue
+        records.append(meta)
+    return records
+
+def required_channels(records):
+    """
+    Return (channels, event IDs) the rules need; channels is None when any rule's
+    channel cannot be determined, in which case nothing may be pruned.
+    """
+    channels = set()
+    event_ids = set()
+    for record in records:
+        needed = rule_channels(record)
+        if needed is None:
+            return None, event_ids
+        channels |= needed
+        event_ids.update(record.get("event_ids", []))
+    return channels, event_ids
+
+def _known_channels():
+    known = set()
+    for channels in list(SERVICE_CHANNELS.values()) + list(CATEGORY_CHANNELS.values()):
+        known.update(channel.lower() for channel in channels)
+    return known
+
+def detect_evtx_channels(file_path, candidates):
+    """
+    Return the set of candidate channels an EVTX file belongs to, or None if unknown.
+
+    Exported logs are normally named after their channel ('%4' standing for '/'); files
+    with other names are identified by searching their first chunk for candidate names.
+    """
+    name = os.path.splitext(os.path.basename(file_path))[0].replace("%4", "/").lower()
+    if name in candidates or "%4" in os.path.basename(file_path):
+        return {name}
+    try:
+        with open(file_path, "rb") as f:
+            head = f.read(EVTX_SNIFF_BYTES)
+    except OSError:
+        return None
+    if not head.startswith(EVTX_MAGIC):
+        return None
+    found = {channel for channel in candidates if _channel_value_pattern(channel).search(head)}
+    return found or None
+
+def prune_evtx_files(root, evtx_files, channels, event_ids=None):
+    """
+    Return the subset of evtx_files (relative to root) whose channel can produce a match
+    for the given channels, and print how many files and bytes were skipped.
+    """
+    if channels is None:
+        print("EVTX pruning: some selected rules have no known channel; all files are kept.")
+        return list(evtx_files)
+    candidates = _known_channels() | channels
+    kept = []
+    skipped_bytes = 0
+    for rel_path in evtx_files:
+        file_path = os.path.join(root, rel_path)
+        found = detect_evtx_channels(file_path, candidates)
+        if found is None or found & channels:
+            kept.append(rel_path)
+        else:
+            try:
+                skipped_bytes += os.path.getsize(file_path)
+            except OSError:
+                pass
+    skipped = len(evtx_files) - len(kept)
+    metrics.count("evtx_files_skipped", skipped)
+    metrics.count("evtx_bytes_skipped", skipped_bytes)
+    print(f"EVTX pruning: kept {len(kept)} of {len(evtx_files)} file(s), skipped {skipped} file(s) "
+          f"({skipped_bytes / (1024 * 1024):.1f} MiB); rules need {len(channels)} channel(s) "
+          f"and {len(event_ids or [])} event ID(s).")
+    return kept
+
+def build_evtx_filter(rules_dir, sigma_builtin_dir, workers=None):
+    """
+    Return a function (root, evtx files) -> kept evtx files that prunes EVTX files no rule
+    in rules_dir can match, for use by the hayabusa runners.
+    """
+    channels, event_ids = required_channels(load_rules_for_pruning(rules_dir, sigma_builtin_dir, workers))
+
+    def evtx_filter(root, evtx_files):
+        return prune_evtx_files(root, evtx_files, channels, event_ids)
+    return evtx_filter
@@ -1,12 +1,335 @@
+import os
+import csv
+import json
+import heapq
+import time
+import hashlib
 import subprocess
+import metrics
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from materializer import materialize_rules
 
-def run_hayabusa_command(evtx_flag=None, evtx_file=None):
-    """Execute the hayabusa command with an optional evtx file parameter."""
+def run_hayabusa_command(evtx_flag=None, evtx_file=None, evtx_filter=None, staging_dir="hayabusa_pruned",
+                         output_csv=None, profile="verbose"):
+    """Execute the hayabusa command with an optional evtx file parameter.
+
+    When evtx_filter is given, only the EVTX files it keeps are passed to hayabusa,
+    through a directory of symlinks at staging_dir. When output_csv is given, the
+    timeline is written there with the given profile instead of only being printed.
+    Returns True if hayabusa completed successfully.
+    """
+    if evtx_filter and evtx_flag and evtx_file:
+        root, evtx_files = collect_evtx_files(evtx_flag, evtx_file)
+        evtx_files = evtx_filter(root, evtx_files)
+        if not evtx_files:
+            print("No EVTX files left to scan after pruning; hayabusa was not run.")
+            return False
+        materialize_rules(staging_dir, {rel: os.path.join(root, rel) for rel in evtx_files}, "symlink")
+        evtx_flag, evtx_file = "-d", staging_dir
     cmd = ["hayabusa", "csv-timeline", "--no-wizard", "--quiet", "--rules", "chainrule"]
     if evtx_flag and evtx_file:
         cmd.extend([evtx_flag, evtx_file])
+    if output_csv:
+        cmd.extend(["--output", output_csv, "--profile", profile, "--clobber"])
+    started = time.perf_counter()
     try:
         print("\n\nExecuting hayabusa...\n\n")
         subprocess.run(cmd, check=True)
+        metrics.record_subprocess("hayabusa", cmd, time.perf_counter() - started, 0)
+        return True
+    except subprocess.CalledProcessError as e:
+        metrics.record_subprocess("hayabusa", cmd, time.perf_counter() - started, e.returncode)
+        print(f"Error running hayabusa command: {e}")
+        return False
     except Exception as e:
+        metrics.record_subprocess("hayabusa", cmd, time.perf_counter() - started, None, str(e))
         print(f"Error running hayabusa command: {e}")
+        return False
+
+# hayabusa reads its rule config (field mappings, noisy-rule lists, etc.) from here unless
+# --rules-config is given, which ThreatStalker never does.
+HAYABUSA_RULES_CONFIG = os.path.join("rules", "config")
+
+def get_hayabusa_version():
+    """
+    Return the output of `hayabusa --version`, or None if hayabusa could not be run.
+    """
+    try:
+        completed = subprocess.run(["hayabusa", "--version"], capture_output=True, text=True)
+    except Exception:
+        return None
+    return (completed.stdout + completed.stderr).strip() or None
+
+def parse_hayabusa_timestamp(value):
+    """
+    Convert a hayabusa timestamp (e.g. '2019-03-19 23:34:25.000 +09:00') to epoch seconds.
+    Timestamps without an offset are taken as UTC; unparseable values sort last.
+    """
+    text = value.strip()
+    if len(text) > 6 and text[-6] in "+-" and text[-7] == " ":
+        text = text[:-7] + text[-6:]
+    try:
+        parsed = datetime.fromisoformat(text)
+    except ValueError:
+        return float("inf")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+def collect_evtx_files(evtx_flag, evtx_path):
+    """
+    Return (root, [relative paths]) of the .evtx files addressed by -d or -f.
+    """
+    if evtx_flag == "-f":
+        return os.path.dirname(os.path.abspath(evtx_path)), [os.path.basename(evtx_path)]
+    root = os.path.abspath(evtx_path)
+    evtx_files = []
+    for dirpath, dirs, files in os.walk(root):
+        dirs.sort()
+        for file in sorted(files):
+            if file.lower().endswith(".evtx"):
+                evtx_files.append(os.path.relpath(os.path.join(dirpath, file), root))
+    return root, evtx_files
+
+def plan_shards(root, evtx_files, shard_count):
+    """
+    Split evtx_files into at most shard_count groups of roughly equal total size.
+    Largest files are assigned first, each to the currently lightest shard.
+    """
+    sizes = {}
+    for rel_path in evtx_files:
+        try:
+            sizes[rel_path] = os.path.getsize(os.path.join(root, rel_path))
+        except OSError:
+            sizes[rel_path] = 0
+    shard_count = max(1, min(shard_count, len(evtx_files)))
+    heap = [(0, i) for i in range(shard_count)]
+    shards = [[] for _ in range(shard_count)]
+    for rel_path in sorted(evtx_files, key=lambda p: (-sizes[p], p)):
+        total, i = heapq.heappop(heap)
+        shards[i].append(rel_path)
+        heapq.heappush(heap, (total + sizes[rel_path], i))
+    return [sorted(shard) for shard in shards if shard]
+
+def _fingerprint_rules(rules_dir):
+    """
+    Return a digest of the rule set (paths, sizes and mtimes) used to invalidate shard results.
+    """
+    digest = hashlib.sha256()
+    for dirpath, dirs, files in os.walk(rules_dir):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(dirpath, file)
+            st = os.stat(file_path)
+            digest.update(f"{os.path.relpath(file_path, rules_dir)}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+def _fingerprint_evtx(root, evtx_files):
+    """
+    Return a digest of a shard's EVTX files (paths, sizes and mtimes).
+    """
+    digest = hashlib.sha256()
+    for rel_path in evtx_files:
+        try:
+            st = os.stat(os.path.join(root, rel_path))
+            digest.update(f"{rel_path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+        except OSError:
+            digest.update(f"{rel_path}\0missing\n".encode())
+    return digest.hexdigest()
+
+def run_hayabusa_timeline(evtx_flag, evtx_path, rules_dir, output_csv, log_path, threads=None, profile="verbose"):
+    """
+    Run one hayabusa csv-timeline process writing to output_csv, with its console output
+    sent to log_path. Returns (exit code, error message); the exit code is None if
+    hayabusa could not be started.
+    """
+    cmd = [
+        "hayabusa", "csv-timeline", "--no-wizard", "--quiet", "--clobber",
+        "--rules", rules_dir, evtx_flag, evtx_path, "--output", output_csv,
+        "--profile", profile,
+    ]
+    if threads:
+        cmd.extend(["--threads", str(threads)])
+    started = time.perf_counter()
+    with open(log_path, "w", encoding="utf-8") as log:
+        try:
+            completed = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT)
+            metrics.record_subprocess("hayabusa", cmd, time.perf_counter() - started, completed.returncode)
+            return completed.returncode, None
+        except Exception as e:
+            metrics.record_subprocess("hayabusa", cmd, time.perf_counter() - started, None, str(e))
+            return None, str(e)
+
+def read_timeline(csv_path):
+    """
+    Yield (sort key, row) for each detection in a hayabusa CSV timeline.
+    """
+    if not os.path.exists(csv_path):
+        return
+    with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        ts_col = header.index("Timestamp") if "Timestamp" in header else 0
+        for seq, row in enumerate(reader):
+            if row:
+                yield (parse_hayabusa_timestamp(row[ts_col]), seq), dict(zip(header, row))
+
+def read_timeline_header(csv_path):
+    """
+    Return the column names of a hayabusa CSV timeline, or [] if it is missing or empty.
+    """
+    try:
+        with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
+            return next(csv.reader(f), [])
+    except OSError:
+        return []
+
+def _restore_evtx_paths(rows, staged_dir, original_root):
+    """
+    Point the EvtxFile column of shard detections back at the original evidence paths.
+    """
+    for key, row in rows:
+        evtx_file = row.get("EvtxFile")
+        if evtx_file and evtx_file.startswith(staged_dir):
+            row["EvtxFile"] = original_root + evtx_file[len(staged_dir):]
+        yield key, row
+
+def merge_timelines(csv_paths, output_csv, staged_dirs=None, original_root=None):
+    """
+    Merge timestamp-sorted hayabusa CSV timelines into one sorted timeline, streaming
+    rows so memory does not grow with the size of the inputs. Returns the row count.
+
+    When staged_dirs (one per CSV) and original_root are given, EvtxFile values under a
+    staged shard directory are rewritten to the matching path under original_root.
+    """
+    header = []
+    for csv_path in csv_paths:
+        for column in read_timeline_header(csv_path):
+            if column not in header:
+                header.append(column)
+    streams = []
+    for i, csv_path in enumerate(csv_paths):
+        rows = read_timeline(csv_path)
+        if staged_dirs:
+            rows = _restore_evtx_paths(rows, staged_dirs[i], original_root)
+        streams.append((((key, i), row) for key, row in rows))
+    count = 0
+    with open(output_csv, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=header, restval="")
+        writer.writeheader()
+        for key, row in heapq.merge(*streams, key=lambda item: item[0]):
+            writer.writerow(row)
+            count += 1
+    return count
+
+def run_hayabusa_sharded(evtx_flag, evtx_path, output_csv, rules_dir="chainrule", shard_count=None,
+                         max_procs=None, threads_per_proc=None, work_dir="hayabusa_shards",
+                         profile="verbose", evtx_filter=None):
+    """
+    Run hayabusa csv-timeline over size-balanced shards of the EVTX files in parallel and
+    merge the shard timelines into output_csv, sorted by timestamp.
+
+    At most max_procs hayabusa processes run at once, each limited to threads_per_proc
+    threads. Each shard gets its own directory of links to its EVTX files, CSV and console
+    log under work_dir. Shard state is kept in work_dir/shards.json: when the command is
+    rerun with the same EVTX files and rules, shards that already succeeded are reused and
+    only failed shards are run again. evtx_filter optionally narrows the EVTX files
+    (see evtx_pruner.build_evtx_filter).
+
+    Returns the list of shard states, each with its 'status' and 'returncode'.
+    """
+    cpu_count = os.cpu_count() or 1
+    max_procs = max_procs or max(1, cpu_count // 4)
+    shard_count = shard_count or max_procs
+    threads_per_proc = threads_per_proc or max(1, cpu_count // max_procs)
+
+    root, evtx_files = collect_evtx_files(evtx_flag, evtx_path)
+    if evtx_filter:
+        evtx_files = evtx_filter(root, evtx_files)
+    if not evtx_files:
+        print(f"No .evtx files to scan in {evtx_path}")
+        return []
+
+    os.makedirs(work_dir, exist_ok=True)
+    state_path = os.path.join(work_dir, "shards.json")
+    plan = plan_shards(root, evtx_files, shard_count)
+    rules_fingerprint = _fingerprint_rules(rules_dir)
+
+    previous = {}
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("root") == root and state.get("rules") == rules_fingerprint:
+            previous = {tuple(shard["files"]): shard for shard in state.get("shards", [])}
+    except (OSError, ValueError):
+        pass
+
+    shards = []
+    for i, files in enumerate(plan):
+        shard_dir = os.path.join(work_dir, f"shard_{i:03d}")
+        shard = {
+            "files": files,
+            "fingerprint": _fingerprint_evtx(root, files),
+            "dir": os.path.abspath(os.path.join(shard_dir, "evtx")),
+            "csv": os.path.abspath(os.path.join(shard_dir, "timeline.csv")),
+            "log": os.path.abspath(os.path.join(shard_dir, "hayabusa.log")),
+            "status": "pending",
+            "returncode": None,
+        }
+        done = previous.get(tuple(files))
+        if (done and done.get("status") == "ok" and done.get("fingerprint") == shard["fingerprint"]
+                and done.get("csv") == shard["csv"] and os.path.exists(shard["csv"])):
+            shard["status"] = "ok"
+            shard["returncode"] = 0
+        shards.append(shard)
+
+    def save_state():
+        tmp_path = state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"root": root, "rules": rules_fingerprint, "shards": shards}, f, indent=2)
+        os.replace(tmp_path, state_path)
+
+    pending = [shard for shard in shards if shard["status"] != "ok"]
+    metrics.cache("hayabusa_shards", len(shards) - len(pending), len(pending))
+    print(f"\n\nExecuting hayabusa on {len(evtx_files)} EVTX file(s) in {len(shards)} shard(s), "
+          f"{len(shards) - len(pending)} reused, up to {max_procs} process(es) x {threads_per_proc} thread(s)...\n")
+
+    for shard in pending:
+        # Symlinks keep evidence on other filesystems from being copied
+        materialize_rules(shard["dir"], {rel: os.path.join(root, rel) for rel in shard["files"]}, "symlink")
+
+    def run(shard):
+        # Workers only return results; the shared shard states are updated and saved on
+        # this thread, so save_state never serializes a dict that is being mutated
+        return run_hayabusa_timeline(
+            "--directory", shard["dir"], rules_dir, shard["csv"], shard["log"], threads_per_proc, profile
+        )
+
+    with ThreadPoolExecutor(max_workers=max_procs) as executor:
+        futures = {executor.submit(run, shard): shard for shard in pending}
+        for future in as_completed(futures):
+            shard = futures[future]
+            shard["returncode"], error = future.result()
+            shard["status"] = "ok" if shard["returncode"] == 0 else "failed"
+            if error:
+                shard["error"] = error
+            save_state()
+
+    save_state()
+    failed = [shard for shard in shards if shard["status"] != "ok"]
+    for i, shard in enumerate(shards):
+        detail = shard.get("error") or f"exit code {shard['returncode']}"
+        print(f"shard {i:03d}: {shard['status']} ({len(shard['files'])} file(s), {detail})")
+    if failed:
+        print(f"\n{len(failed)} shard(s) failed; see their hayabusa.log under {work_dir}. "
+              f"Rerun the same command to retry only the failed shards.")
+        return shards
+
+    count = merge_timelines(
+        [shard["csv"] for shard in shards], output_csv, [shard["dir"] for shard in shards], root
+    )
+    print(f"\nMerged {count} detection(s) into {output_csv}")
+    return shards
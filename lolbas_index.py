@@ -0,0 +1,150 @@
+import os
+import json
+import hashlib
+import metrics
+from yaml_loader import load_yaml_files
+from rule_index import get_cache_dir, load_rule_index, scan_rule_files
+
+# Bump whenever the layout of the LOLBAS index changes so stale indexes are rebuilt.
+LOLBAS_INDEX_VERSION = 1
+
+def extract_sigma_filenames(data):
+    """
+    Return the Sigma rule basenames referenced by a LOLBAS entry's Detection section.
+    """
+    filenames = []
+    # Check if 'Detection' key exists and is a list
+    if isinstance(data, dict) and isinstance(data.get("Detection"), list):
+        for entry in data["Detection"]:
+            if isinstance(entry, dict) and "Sigma" in entry:
+                sigma_url = entry["Sigma"]
+                if sigma_url and isinstance(sigma_url, str):
+                    filenames.append(sigma_url.rstrip("/").split("/")[-1])
+    return filenames
+
+def extract_lolbas_entry(data):
+    """
+    Return the binary name and referenced Sigma rule basenames of a LOLBAS entry.
+    """
+    name = data.get("Name") if isinstance(data, dict) else None
+    return {"name": name if isinstance(name, str) else None, "sigma": extract_sigma_filenames(data)}
+
+def fingerprint_tree(root):
+    """
+    Return a digest of the .yml files below root (paths, sizes and mtimes), or None if
+    root does not exist. Only file metadata is read.
+    """
+    if not os.path.isdir(root):
+        return None
+    digest = hashlib.sha256()
+    for rel_path, st in scan_rule_files(root):
+        digest.update(f"{rel_path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+def build_lolbas_index(lolbas_dir, sigma_builtin_dir, workers=None):
+    """
+    Parse the LOLBAS entries and resolve their Sigma references against the rule index.
+
+    Returns {'binaries': {lowercased name: {'name', 'sigma': [basenames]}},
+    'rules': {basename: {'path', 'tagged', 'tactics'}}}, where 'rules' only holds
+    referenced rules found below sigma_builtin_dir.
+    """
+    lolbas_files = [os.path.join(lolbas_dir, rel_path) for rel_path, st in scan_rule_files(lolbas_dir)]
+    metrics.count("lolbas_files_parsed", len(lolbas_files))
+    binaries = {}
+    referenced = set()
+    for file_path, entry, error in load_yaml_files(lolbas_files, workers=workers, transform=extract_lolbas_entry):
+        if error is not None:
+            print(f"Error reading file {file_path}: {error}")
+            continue
+        name = entry["name"] or os.path.splitext(os.path.basename(file_path))[0]
+        binary = binaries.setdefault(name.lower(), {"name": name, "sigma": []})
+        for filename in entry["sigma"]:
+            if filename not in binary["sigma"]:
+                binary["sigma"].append(filename)
+        referenced.update(entry["sigma"])
+
+    rules = {}
+    if os.path.exists(sigma_builtin_dir):
+        records = load_rule_index(sigma_builtin_dir, workers=workers)
+        for rel_path in sorted(records):
+            record = records[rel_path]
+            basename = os.path.basename(rel_path)
+            if basename in referenced and basename not in rules:
+                rules[basename] = {
+                    "path": record["path"], "tagged": record["tagged"], "tactics": record["tactics"],
+                }
+    return {"binaries": binaries, "rules": rules}
+
+def load_lolbas_index(lolbas_dir, sigma_builtin_dir, index_path=None, workers=None):
+    """
+    Return the LOLBAS index (see build_lolbas_index), served from cache/lolbas_index.json
+    while neither the LOLBAS nor the hayabusa-rules tree has changed. Changes are detected
+    from file paths, sizes and mtimes, so a warm load parses no YAML at all.
+    """
+    if index_path is None:
+        index_path = os.path.join(get_cache_dir(), "lolbas_index.json")
+    fingerprint = {
+        "version": LOLBAS_INDEX_VERSION,
+        "lolbas_root": os.path.abspath(lolbas_dir),
+        "rules_root": os.path.abspath(sigma_builtin_dir),
+        "lolbas": fingerprint_tree(lolbas_dir),
+        "rules": fingerprint_tree(sigma_builtin_dir),
+    }
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("fingerprint") == fingerprint:
+            metrics.cache("lolbas_index", 1, 0)
+            return cached["index"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    metrics.cache("lolbas_index", 0, 1)
+    index = build_lolbas_index(lolbas_dir, sigma_builtin_dir, workers)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint, "index": index}, f, separators=(",", ":"))
+    os.replace(tmp_path, index_path)
+    return index
+
+def _match_binary(binaries, query):
+    """
+    Return the index key for a binary given as e.g. 'certutil', 'Certutil.exe' or 'certutil.exe'.
+    """
+    query = query.lower()
+    if query in binaries:
+        return query
+    for key in binaries:
+        if os.path.splitext(key)[0] == query:
+            return key
+    return None
+
+def select_lolbas_rules(index, binaries=None):
+    """
+    Return ({basename: rule path} for the Sigma rules referenced by the selected binaries
+    (all binaries if none are given), [unknown binary names], [unresolved basenames]).
+    """
+    if binaries:
+        keys = []
+        unknown = []
+        for query in binaries:
+            key = _match_binary(index["binaries"], query)
+            if key is None:
+                unknown.append(query)
+            elif key not in keys:
+                keys.append(key)
+    else:
+        keys = sorted(index["binaries"])
+        unknown = []
+    selected = {}
+    unresolved = []
+    for key in keys:
+        for filename in index["binaries"][key]["sigma"]:
+            rule = index["rules"].get(filename)
+            if rule is None:
+                if filename not in unresolved:
+                    unresolved.append(filename)
+            else:
+                selected.setdefault(filename, rule["path"])
+    return selected, unknown, unresolved
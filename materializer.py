@@ -0,0 +1,283 @@
+import os
+import time
+import errno
+import ctypes
+import shutil
+import contextlib
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+LINK_MODES = ("hardlink", "symlink", "copy")
+
+# renameat2() flag swapping two paths atomically (Linux 3.15+, glibc 2.28+).
+_AT_FDCWD = -100
+_RENAME_EXCHANGE = 2
+
+def _scan_output(output_dir):
+    """
+    Return the set of relative file paths (including symlinks) below output_dir.
+    """
+    existing = set()
+    if not os.path.isdir(output_dir):
+        return existing
+    for root, dirs, files in os.walk(output_dir):
+        for file in files:
+            existing.add(os.path.relpath(os.path.join(root, file), output_dir))
+    return existing
+
+def _is_current(dst, src, link_mode):
+    """
+    Return True if dst already provides src's current content in the requested mode.
+    """
+    try:
+        dst_st = os.lstat(dst)
+        src_st = os.stat(src)
+    except OSError:
+        return False
+    if link_mode == "symlink":
+        return os.path.islink(dst) and os.readlink(dst) == os.path.abspath(src)
+    if os.path.islink(dst):
+        return False
+    same_inode = (dst_st.st_dev, dst_st.st_ino) == (src_st.st_dev, src_st.st_ino)
+    same_copy = dst_st.st_size == src_st.st_size and dst_st.st_mtime_ns == src_st.st_mtime_ns
+    if link_mode == "hardlink":
+        # Copies are accepted too since hardlinking falls back to copying.
+        return same_inode or same_copy
+    return same_copy and not same_inode
+
+def _read_text(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+def _place(src, dst, link_mode):
+    """
+    Create dst from src using link_mode, falling back to a copy if linking fails.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if link_mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    elif link_mode == "symlink":
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+def _carry_over(old, dst):
+    """
+    Bring an unchanged entry of the current output into the staging directory without
+    rewriting its data. Returns False if that was not possible.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        if os.path.islink(old):
+            os.symlink(os.readlink(old), dst)
+        else:
+            os.link(old, dst)
+    except OSError:
+        return False
+    return True
+
+def _exchange_paths(a, b):
+    """
+    Atomically swap the directory entries a and b. Returns False where renameat2 with
+    RENAME_EXCHANGE is unavailable.
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError):
+        return False
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    if renameat2(_AT_FDCWD, os.fsencode(a), _AT_FDCWD, os.fsencode(b), _RENAME_EXCHANGE) != 0:
+        error = ctypes.get_errno()
+        if error in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+            return False
+        raise OSError(error, os.strerror(error), a)
+    return True
+
+def _version_dirs(output_dir):
+    """
+    Return the versioned directories of output_dir (see materialize_rules), oldest first.
+    """
+    parent = os.path.dirname(os.path.abspath(output_dir))
+    prefix = f".{os.path.basename(os.path.abspath(output_dir))}.v"
+    try:
+        names = os.listdir(parent)
+    except OSError:
+        return []
+    return sorted(os.path.join(parent, name) for name in names if name.startswith(prefix))
+
+@contextlib.contextmanager
+def _output_lock(output_dir):
+    """
+    Hold an exclusive lock on .<name>.lock next to output_dir, so only one process at a
+    time (e.g. the daemon and a local CLI run) builds, swaps in and prunes its versions.
+    """
+    parent = os.path.dirname(os.path.abspath(output_dir))
+    os.makedirs(parent, exist_ok=True)
+    with open(os.path.join(parent, f".{os.path.basename(os.path.abspath(output_dir))}.lock"), "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _swap_in(output_dir, version_dir):
+    """
+    Point the output_dir symlink at version_dir with a single rename, so output_dir always
+    resolves to a complete rule set. A real directory left at output_dir by an older version
+    is exchanged with the new symlink atomically where the platform allows it.
+    """
+    parent = os.path.dirname(os.path.abspath(output_dir))
+    tmp_link = os.path.join(parent, f".{os.path.basename(os.path.abspath(output_dir))}.link-{os.getpid()}")
+    if os.path.lexists(tmp_link):
+        os.unlink(tmp_link)
+    os.symlink(os.path.basename(version_dir), tmp_link)
+    if os.path.isdir(output_dir) and not os.path.islink(output_dir):
+        if not _exchange_paths(tmp_link, output_dir):
+            # No atomic exchange available: output_dir is briefly missing, once, on migration
+            os.rename(output_dir, tmp_link + ".old")
+            os.rename(tmp_link, output_dir)
+            tmp_link += ".old"
+        shutil.rmtree(tmp_link)
+    else:
+        os.replace(tmp_link, output_dir)
+
+def check_output_dir(output_dir, marker=None):
+    """
+    Raise ValueError unless output_dir may be replaced wholesale by materialize_rules: it
+    does not exist or is empty, it is a symlink to one of its own versioned directories, or
+    it holds the marker file (output written before versioning).
+    """
+    if not os.path.lexists(output_dir):
+        return
+    if os.path.islink(output_dir):
+        name = os.path.basename(os.path.abspath(output_dir))
+        target = os.readlink(output_dir)
+        if os.sep not in target and target.startswith(f".{name}.v") and os.path.isdir(output_dir):
+            return
+    elif os.path.isdir(output_dir):
+        if not os.listdir(output_dir) or (marker and os.path.isfile(os.path.join(output_dir, marker))):
+            return
+    raise ValueError(f"'{output_dir}' already exists and was not written by ThreatStalker; remove it or choose another output directory")
+
+def remove_output(output_dir):
+    """
+    Remove output_dir as written by materialize_rules, together with its versioned directories.
+    """
+    if os.path.islink(output_dir):
+        os.unlink(output_dir)
+    elif os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    for version_dir in _version_dirs(output_dir):
+        shutil.rmtree(version_dir, ignore_errors=True)
+
+def materialize_rules(output_dir, desired, link_mode="hardlink", extra_files=None):
+    """
+    Make output_dir contain exactly the files in desired ({relative path: source path}).
+
+    The desired layout is diffed against what output_dir already holds; if nothing changed,
+    nothing is written. Otherwise the new layout is assembled in a new versioned directory
+    next to output_dir (.<name>.v<timestamp>-<pid>), where unchanged files are carried over as
+    hardlinks of the existing entries and only new or modified rules are linked (hardlink or
+    symlink) or copied from their source. output_dir itself is a symlink that is then
+    repointed at the new version by renaming a temporary symlink over it, so a concurrently
+    starting hayabusa always finds output_dir and never reads a half-built rule set. The
+    previous version is kept until the next update, for readers that already resolved it.
+    Writers to the same output_dir are serialized through a lock file next to it, so no
+    version is pruned while another process is still building it.
+
+    extra_files is an optional callable receiving the successfully placed {relative path:
+    source path} mapping and returning {relative path: text} for generated files such as
+    the chainrule manifest.
+
+    Returns (placed, stats) where stats counts 'added', 'removed' and 'unchanged' files.
+    """
+    if link_mode not in LINK_MODES:
+        raise ValueError(f"Unknown link mode '{link_mode}' (expected one of {', '.join(LINK_MODES)})")
+    with _output_lock(output_dir):
+        return _materialize(output_dir, desired, link_mode, extra_files)
+
+def _materialize(output_dir, desired, link_mode, extra_files):
+    existing = _scan_output(output_dir)
+    current = {rel for rel, src in desired.items()
+               if rel in existing and _is_current(os.path.join(output_dir, rel), src, link_mode)}
+    extras = extra_files(desired) if extra_files else {}
+    current_extras = {rel for rel, text in extras.items()
+                      if rel in existing and _read_text(os.path.join(output_dir, rel)) == text}
+
+    stats = {
+        "added": len(desired) - len(current) + len(extras) - len(current_extras),
+        "removed": len(existing - set(desired) - set(extras)),
+        "unchanged": len(current) + len(current_extras),
+    }
+    metrics.cache("materialize", stats["unchanged"], stats["added"])
+    metrics.count("files_written", stats["added"])
+    metrics.count("files_removed", stats["removed"])
+    if not stats["added"] and not stats["removed"] and os.path.isdir(output_dir):
+        return dict(desired), stats
+
+    parent = os.path.dirname(os.path.abspath(output_dir))
+    name = os.path.basename(os.path.abspath(output_dir))
+    os.makedirs(parent, exist_ok=True)
+    previous = os.path.realpath(output_dir) if os.path.islink(output_dir) else None
+    version_dir = os.path.join(parent, f".{name}.v{time.time_ns()}-{os.getpid()}")
+    os.makedirs(version_dir)
+
+    placed = {}
+    try:
+        for rel in sorted(desired):
+            src = desired[rel]
+            dst = os.path.join(version_dir, rel)
+            try:
+                if rel in current and _carry_over(os.path.join(output_dir, rel), dst):
+                    placed[rel] = src
+                    continue
+                _place(src, dst, link_mode)
+                placed[rel] = src
+            except Exception as e:
+                print(f"Error copying file {src}: {e}")
+
+        if extra_files:
+            for rel, text in extra_files(placed).items():
+                dst = os.path.join(version_dir, rel)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                with open(dst, "w", encoding="utf-8") as f:
+                    f.write(text)
+
+        _swap_in(output_dir, version_dir)
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+    # Keep the new and the previous version; older ones have no readers left, and no other
+    # writer can be building one while the lock is held
+    for stale_dir in _version_dirs(output_dir):
+        if stale_dir not in (version_dir, previous):
+            shutil.rmtree(stale_dir, ignore_errors=True)
+    return placed, stats
@@ -0,0 +1,177 @@
+import os
+import sys
+import json
+import time
+import contextlib
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+METRICS_VERSION = 1
+
+# Collector of the current run, or None when instrumentation is off. All helpers below
+# return immediately in that case, so instrumented code pays one global lookup per call.
+_collector = None
+_NULL_STAGE = contextlib.nullcontext()
+
+def _read_proc_io():
+    """
+    Return this process's I/O counters from /proc/self/io, or {} where unavailable.
+    """
+    try:
+        with open("/proc/self/io", "r", encoding="ascii") as f:
+            return {key: int(value) for key, value in (line.split(": ") for line in f if ": " in line)}
+    except (OSError, ValueError):
+        return {}
+
+def _snapshot():
+    times = os.times()
+    proc_io = _read_proc_io()
+    return {
+        "wall": time.perf_counter(),
+        "cpu": times.user + times.system,
+        "children_cpu": times.children_user + times.children_system,
+        "bytes_read": proc_io.get("rchar", 0),
+        "bytes_written": proc_io.get("wchar", 0),
+        "read_calls": proc_io.get("syscr", 0),
+        "write_calls": proc_io.get("syscw", 0),
+        **_block_io(),
+    }
+
+def _block_io():
+    if resource is None:
+        return {"block_reads": 0, "block_writes": 0}
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "block_reads": own.ru_inblock + children.ru_inblock,
+        "block_writes": own.ru_oublock + children.ru_oublock,
+    }
+
+def _peak_rss_kb():
+    if resource is None:
+        return {"self": None, "children": None}
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+class MetricsCollector:
+    """
+    Per-stage wall/CPU time, I/O and peak RSS, plus counters, cache hit rates and
+    subprocess runs reported by the instrumented modules.
+    """
+
+    def __init__(self):
+        self.started = _snapshot()
+        self.stages = []
+        self.active = []
+        self.counters = {}
+        self.caches = {}
+        self.subprocesses = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        path = "/".join([entry["name"] for entry in self.active] + [name])
+        entry = {"name": name, "stage": path, "counters": {}}
+        self.active.append(entry)
+        before = _snapshot()
+        try:
+            yield
+        finally:
+            after = _snapshot()
+            self.active.pop()
+            entry["start_s"] = round(before["wall"] - self.started["wall"], 6)
+            entry["wall_s"] = round(after["wall"] - before["wall"], 6)
+            entry["cpu_s"] = round(after["cpu"] - before["cpu"], 6)
+            entry["children_cpu_s"] = round(after["children_cpu"] - before["children_cpu"], 6)
+            for key in ("bytes_read", "bytes_written", "read_calls", "write_calls", "block_reads", "block_writes"):
+                entry[key] = after[key] - before[key]
+            entry["peak_rss_kb"] = _peak_rss_kb()
+            del entry["name"]
+            self.stages.append(entry)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+        for entry in self.active:
+            entry["counters"][name] = entry["counters"].get(name, 0) + value
+
+    def cache(self, name, hits, misses):
+        totals = self.caches.setdefault(name, {"hits": 0, "misses": 0})
+        totals["hits"] += hits
+        totals["misses"] += misses
+
+    def report(self):
+        ended = _snapshot()
+        caches = {}
+        for name, totals in self.caches.items():
+            lookups = totals["hits"] + totals["misses"]
+            caches[name] = dict(totals, hit_rate=round(totals["hits"] / lookups, 4) if lookups else None)
+        return {
+            "version": METRICS_VERSION,
+            "argv": sys.argv,
+            "total": {
+                "wall_s": round(ended["wall"] - self.started["wall"], 6),
+                "cpu_s": round(ended["cpu"] - self.started["cpu"], 6),
+                "children_cpu_s": round(ended["children_cpu"] - self.started["children_cpu"], 6),
+                "bytes_read": ended["bytes_read"] - self.started["bytes_read"],
+                "bytes_written": ended["bytes_written"] - self.started["bytes_written"],
+                "peak_rss_kb": _peak_rss_kb(),
+            },
+            "stages": sorted(self.stages, key=lambda entry: entry["start_s"]),
+            "counters": self.counters,
+            "caches": caches,
+            "subprocesses": self.subprocesses,
+        }
+
+def enable():
+    """
+    Turn instrumentation on for the rest of the run.
+    """
+    global _collector
+    _collector = MetricsCollector()
+    return _collector
+
+def stage(name):
+    """
+    Context manager timing a stage; a shared no-op context when instrumentation is off.
+    """
+    if _collector is None:
+        return _NULL_STAGE
+    return _collector.stage(name)
+
+def count(name, value=1):
+    """
+    Add value to a named counter (e.g. 'files_written') of the run and of the active stages.
+    """
+    if _collector is not None:
+        _collector.count(name, value)
+
+def cache(name, hits, misses):
+    """
+    Record lookups of a named cache (e.g. 'rule_index') that hit or missed.
+    """
+    if _collector is not None:
+        _collector.cache(name, hits, misses)
+
+def record_subprocess(name, cmd, seconds, returncode, error=None):
+    """
+    Record an external command's runtime and exit status (None if it could not start).
+    """
+    if _collector is not None:
+        _collector.subprocesses.append({
+            "name": name, "cmd": cmd, "stage": "/".join(entry["name"] for entry in _collector.active) or None,
+            "wall_s": round(seconds, 6), "returncode": returncode, "error": error,
+        })
+
+def write_report(path):
+    """
+    Write the collected metrics as JSON to path.
+    """
+    if _collector is None:
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(_collector.report(), f, indent=2)
+    print(f"Metrics written to {path}")
@@ -0,0 +1,254 @@
+import os
+import csv
+import json
+import shutil
+import sqlite3
+import hashlib
+import metrics
+from rule_index import get_cache_dir
+from materializer import materialize_rules
+from hayabusa_runner import (
+    collect_evtx_files, run_hayabusa_timeline, run_hayabusa_sharded, read_timeline, read_timeline_header,
+    get_hayabusa_version, HAYABUSA_RULES_CONFIG,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY, value TEXT
+);
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT
+);
+CREATE TABLE IF NOT EXISTS columns (
+    profile TEXT PRIMARY KEY, names TEXT
+);
+CREATE TABLE IF NOT EXISTS evaluated (
+    evtx_hash TEXT, rule_hash TEXT, profile TEXT,
+    PRIMARY KEY (evtx_hash, rule_hash, profile)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS detections (
+    evtx_hash TEXT, rule_hash TEXT, profile TEXT, ts REAL, seq INTEGER, row TEXT
+);
+CREATE INDEX IF NOT EXISTS detections_pair ON detections (evtx_hash, rule_hash, profile);
+"""
+
+def open_result_cache(db_path=None):
+    """
+    Open (creating if needed) the detection cache database.
+    """
+    if db_path is None:
+        db_path = os.path.join(get_cache_dir(), "detections.sqlite")
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+def hash_file(conn, file_path):
+    """
+    Return the SHA-256 of file_path, reusing the stored digest while the file's
+    size and mtime are unchanged.
+    """
+    file_path = os.path.abspath(file_path)
+    st = os.stat(file_path)
+    row = conn.execute(
+        "SELECT size, mtime_ns, sha256 FROM file_hashes WHERE path = ?", (file_path,)
+    ).fetchone()
+    if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+        return row[2]
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    sha256 = digest.hexdigest()
+    conn.execute(
+        "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+        (file_path, st.st_size, st.st_mtime_ns, sha256),
+    )
+    return sha256
+
+def engine_stamp(conn, rules_config_dir=HAYABUSA_RULES_CONFIG):
+    """
+    Return a digest of what, besides the EVTX file and the rule, decides hayabusa's
+    detections: the `hayabusa --version` output and the rule config directory's path and
+    file contents.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{get_hayabusa_version()}\0{os.path.abspath(rules_config_dir)}\n".encode())
+    for root, dirs, files in os.walk(rules_config_dir):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            digest.update(f"{os.path.relpath(file_path, rules_config_dir)}\0{hash_file(conn, file_path)}\n".encode())
+    return digest.hexdigest()
+
+def check_engine_stamp(conn, stamp):
+    """
+    Drop all cached detections unless they were produced under this engine stamp (see
+    engine_stamp). Returns True if cached detections were dropped.
+    """
+    row = conn.execute("SELECT value FROM meta WHERE key = 'engine'").fetchone()
+    if row and row[0] == stamp:
+        return False
+    invalidated = conn.execute("DELETE FROM evaluated").rowcount > 0
+    conn.execute("DELETE FROM detections")
+    conn.execute("DELETE FROM columns")
+    conn.execute("INSERT OR REPLACE INTO meta VALUES ('engine', ?)", (stamp,))
+    conn.commit()
+    return invalidated
+
+def _collect_rules(rules_dir):
+    rule_files = []
+    for root, dirs, files in os.walk(rules_dir):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(".yml"):
+                rule_files.append(os.path.join(root, file))
+    return rule_files
+
+def _store_group_output(conn, csv_path, profile, rule_hashes):
+    """
+    Attribute each detection of a hayabusa run over hash-named inputs back to its
+    (EVTX hash, rule hash) pair and store it. Returns False if the output lacks the
+    RuleFile/EvtxFile columns needed for attribution.
+    """
+    header = read_timeline_header(csv_path)
+    if header:
+        if "RuleFile" not in header or "EvtxFile" not in header:
+            print(f"Error: hayabusa profile '{profile}' does not output RuleFile and EvtxFile; results not cached.")
+            return False
+        conn.execute("INSERT OR REPLACE INTO columns VALUES (?, ?)", (profile, json.dumps(header)))
+    rows = []
+    for (ts, seq), row in read_timeline(csv_path):
+        rule_hash = os.path.splitext(os.path.basename(row["RuleFile"]))[0]
+        evtx_hash = os.path.splitext(os.path.basename(row["EvtxFile"].replace("\\", "/")))[0]
+        if rule_hash not in rule_hashes:
+            continue
+        rows.append((evtx_hash, rule_hash, profile, ts, seq, json.dumps(row)))
+    conn.executemany("INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?)", rows)
+    return True
+
+def run_hayabusa_cached(evtx_flag, evtx_path, output_csv, rules_dir="chainrule", profile="verbose",
+                        shard_count=None, max_procs=None, threads_per_proc=None,
+                        work_dir="hayabusa_cache_runs", db_path=None, evtx_filter=None):
+    """
+    Produce the hayabusa timeline for the given EVTX files and rules, running hayabusa
+    only for (EVTX file, rule) pairs whose results are not yet in the detection cache.
+
+    Files and rules are identified by content hash, so renamed or copied evidence and rules
+    that appear in several tactic folders are evaluated once. EVTX files that miss the same
+    set of rules are grouped into one hayabusa run over just those rules (sharded when
+    shard_count is given). The cached and new detections are then written to output_csv in
+    timestamp order, with RuleFile and EvtxFile pointing at the current paths. Cached
+    detections are dropped when the hayabusa version or its rule config changes.
+    evtx_filter optionally narrows the EVTX files (see evtx_pruner.build_evtx_filter).
+    """
+    conn = open_result_cache(db_path)
+    try:
+        if check_engine_stamp(conn, engine_stamp(conn)):
+            print("Detection cache: hayabusa version or rule config changed; cached detections dropped.")
+        root, evtx_files = collect_evtx_files(evtx_flag, evtx_path)
+        if evtx_filter:
+            evtx_files = evtx_filter(root, evtx_files)
+        if not evtx_files:
+            print(f"No .evtx files to scan in {evtx_path}")
+            return False
+        evtx_paths = {}
+        for rel_path in evtx_files:
+            file_path = os.path.join(root, rel_path)
+            evtx_paths.setdefault(hash_file(conn, file_path), []).append(file_path)
+        rule_paths = {}
+        for file_path in _collect_rules(rules_dir):
+            rule_paths.setdefault(hash_file(conn, file_path), file_path)
+        conn.commit()
+
+        # Group EVTX files by the set of rules they still need to be evaluated against
+        groups = {}
+        for evtx_hash in evtx_paths:
+            done = {r for (r,) in conn.execute(
+                "SELECT rule_hash FROM evaluated WHERE evtx_hash = ? AND profile = ?", (evtx_hash, profile)
+            )}
+            missing = frozenset(rule_paths) - done
+            if missing:
+                groups.setdefault(missing, []).append(evtx_hash)
+
+        pairs = len(evtx_paths) * len(rule_paths)
+        missing_pairs = sum(len(rules) * len(hashes) for rules, hashes in groups.items())
+        metrics.cache("detections", pairs - missing_pairs, missing_pairs)
+        print(f"\n\nDetection cache: {pairs - missing_pairs} of {pairs} (EVTX, rule) pair(s) cached, "
+              f"{len(groups)} hayabusa run(s) needed.\n")
+
+        ok = True
+        for i, (missing, evtx_hashes) in enumerate(sorted(groups.items(), key=lambda g: sorted(g[1]))):
+            group_dir = os.path.abspath(os.path.join(work_dir, f"run_{i:03d}"))
+            if os.path.exists(group_dir):
+                shutil.rmtree(group_dir)
+            group_rules = os.path.join(group_dir, "rules")
+            group_evtx = os.path.join(group_dir, "evtx")
+            group_csv = os.path.join(group_dir, "timeline.csv")
+            materialize_rules(group_rules, {f"{h}.yml": rule_paths[h] for h in missing}, "symlink")
+            materialize_rules(group_evtx, {f"{h}.evtx": evtx_paths[h][0] for h in evtx_hashes}, "symlink")
+            print(f"Running hayabusa: {len(evtx_hashes)} EVTX file(s) x {len(missing)} rule(s)")
+
+            if shard_count:
+                shards = run_hayabusa_sharded(
+                    "-d", group_evtx, group_csv, group_rules, shard_count, max_procs, threads_per_proc,
+                    os.path.join(group_dir, "shards"), profile
+                )
+                succeeded = bool(shards) and all(shard["status"] == "ok" for shard in shards)
+            else:
+                returncode, error = run_hayabusa_timeline(
+                    "--directory", group_evtx, group_rules, group_csv,
+                    os.path.join(group_dir, "hayabusa.log"), threads_per_proc, profile
+                )
+                succeeded = returncode == 0
+                if not succeeded:
+                    print(f"Error running hayabusa command: {error or f'exit code {returncode}'} "
+                          f"(see {os.path.join(group_dir, 'hayabusa.log')})")
+            if not succeeded or not _store_group_output(conn, group_csv, profile, missing):
+                ok = False
+                conn.rollback()
+                continue
+            conn.executemany(
+                "INSERT OR IGNORE INTO evaluated VALUES (?, ?, ?)",
+                [(evtx_hash, rule_hash, profile) for evtx_hash in evtx_hashes for rule_hash in missing],
+            )
+            conn.commit()
+            shutil.rmtree(group_dir)
+
+        count = write_cached_timeline(conn, output_csv, evtx_paths, rule_paths, profile)
+        print(f"\nWrote {count} detection(s) to {output_csv}")
+        return ok
+    finally:
+        conn.close()
+
+def write_cached_timeline(conn, output_csv, evtx_paths, rule_paths, profile):
+    """
+    Write the cached detections for the given {hash: paths} EVTX files and {hash: path}
+    rules to output_csv, sorted by timestamp. Returns the row count.
+    """
+    row = conn.execute("SELECT names FROM columns WHERE profile = ?", (profile,)).fetchone()
+    header = json.loads(row[0]) if row else ["Timestamp"]
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS sel_evtx (h TEXT PRIMARY KEY)")
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS sel_rules (h TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM sel_evtx")
+    conn.execute("DELETE FROM sel_rules")
+    conn.executemany("INSERT INTO sel_evtx VALUES (?)", [(h,) for h in evtx_paths])
+    conn.executemany("INSERT INTO sel_rules VALUES (?)", [(h,) for h in rule_paths])
+
+    count = 0
+    with open(output_csv, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=header, restval="", extrasaction="ignore")
+        writer.writeheader()
+        cursor = conn.execute(
+            "SELECT d.evtx_hash, d.rule_hash, d.row FROM detections d "
+            "JOIN sel_evtx e ON d.evtx_hash = e.h JOIN sel_rules r ON d.rule_hash = r.h "
+            "WHERE d.profile = ? ORDER BY d.ts, d.evtx_hash, d.seq",
+            (profile,),
+        )
+        for evtx_hash, rule_hash, row_json in cursor:
+            detection = json.loads(row_json)
+            detection["RuleFile"] = os.path.basename(rule_paths[rule_hash])
+            for evtx_file in evtx_paths[evtx_hash]:
+                detection["EvtxFile"] = evtx_file
+                writer.writerow(detection)
+                count += 1
+    return count
@@ -0,0 +1,271 @@
+import os
+import sys
+import bisect
+from array import array
+from collections import namedtuple
+from rule_index import load_rule_index, TechniqueMatcher
+from rule_cost import apply_cost_budget
+from materializer import check_output_dir
+from sigma_processor import CHAINRULE_MANIFEST, materialize_selection
+from stix_utils import load_actor_table
+from lolbas_index import load_lolbas_index, select_lolbas_rules
+
+RULE_FIELDS = [
+    "path", "id", "techniques", "tactics", "products", "category", "service", "level", "status", "cost", "tagged",
+]
+
+class RuleRecord(namedtuple("RuleRecord", RULE_FIELDS)):
+    """
+    Immutable record of one rule. Records are plain tuples without a per-instance __dict__,
+    and their tag strings and tag tuples are shared across the catalog.
+    """
+    __slots__ = ()
+
+    @property
+    def basename(self):
+        return os.path.basename(self.path)
+
+    def tactic_folders(self, product=None, tactic_filter=None):
+        """
+        Return the tactic folders the rule is selected under for the product and tactic
+        filters (like sigma_processor.match_rule_tactics), or None if it does not match.
+        """
+        if not self.tagged:
+            return None
+        if product is not None and product not in self.products:
+            return None
+        tactic_tags = self.tactics or ("misc",)
+        if tactic_filter is not None:
+            if tactic_filter not in tactic_tags:
+                return None
+            tactic_tags = (tactic_filter,)
+        return tactic_tags
+
+class RuleCatalog:
+    """
+    Read-only in-memory catalog of the Sigma rules of a hayabusa-rules checkout, together
+    with the ATT&CK actor table and the LOLBAS index.
+
+    Queries return RuleRecord tuples in path order and never touch disk. Rules are indexed
+    by technique, tactic and product as arrays of record positions, and looked up by path
+    through binary search. Writing a selection to a chainrule directory is the separate
+    materialize step.
+    """
+
+    def __init__(self, records, actor_table=None, lolbas_index=None):
+        tuples = {}
+
+        def intern_str(value):
+            return sys.intern(value) if isinstance(value, str) else value
+
+        def intern_tuple(values):
+            key = tuple(intern_str(value) for value in values)
+            return tuples.setdefault(key, key)
+
+        rules = []
+        for record in sorted(records, key=lambda record: record["path"]):
+            logsource = record["logsource"]
+            rules.append(RuleRecord(
+                record["path"], record["id"], intern_tuple(record["techniques"]), intern_tuple(record["tactics"]),
+                intern_tuple(logsource["product"]), intern_str(logsource["category"]),
+                intern_str(logsource["service"]), intern_str(record["level"]), intern_str(record["status"]),
+                record.get("cost", 1.0), record["tagged"],
+            ))
+        self._records = tuple(rules)
+        self._by_technique = self._build_index(rule.techniques for rule in rules)
+        self._by_tactic = self._build_index(rule.tactics for rule in rules)
+        self._by_product = self._build_index(rule.products for rule in rules)
+        self._actor_table = actor_table
+        self._lolbas_index = lolbas_index
+
+    @staticmethod
+    def _build_index(keys_per_rule):
+        index = {}
+        for position, keys in enumerate(keys_per_rule):
+            for key in keys:
+                index.setdefault(key, array("I")).append(position)
+        return index
+
+    @classmethod
+    def load(cls, root=None, workers=None):
+        """
+        Load the catalog of the checkout at root (default: the current directory) through
+        the on-disk indexes in root/cache, so only changed rule files are parsed. The actor
+        table and LOLBAS index are left out when mitre_data or LOLBAS is missing.
+        """
+        root = os.path.abspath(root or os.getcwd())
+        cache_dir = os.path.join(root, "cache")
+        os.makedirs(cache_dir, exist_ok=True)
+        rules_dir = os.path.join(root, "hayabusa-rules", "sigma", "builtin")
+        if not os.path.isdir(rules_dir):
+            raise FileNotFoundError(f"'{rules_dir}' directory does not exist.")
+        records = load_rule_index(rules_dir, os.path.join(cache_dir, "rule_index.json"), workers).values()
+
+        stix_file = os.path.join(root, "mitre_data", "enterprise-attack.json")
+        actor_table = None
+        if os.path.exists(stix_file):
+            actor_table = load_actor_table(stix_file, os.path.join(cache_dir, "attack_actors.json"))
+        lolbas_dir = os.path.join(root, "LOLBAS")
+        lolbas_index = None
+        if os.path.isdir(lolbas_dir):
+            lolbas_index = load_lolbas_index(
+                lolbas_dir, rules_dir, os.path.join(cache_dir, "lolbas_index.json"), workers
+            )
+        return cls(records, actor_table, lolbas_index)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def _records_at(self, positions):
+        return tuple(self._records[position] for position in sorted(positions))
+
+    def _technique_positions(self, attack_ids):
+        # Prefix semantics as in TechniqueMatcher: a technique also selects its sub-techniques
+        matcher = TechniqueMatcher(attack_ids)
+        positions = set()
+        for technique, technique_positions in self._by_technique.items():
+            if matcher.matches((technique,)):
+                positions.update(technique_positions)
+        return positions
+
+    def _lolbin_positions(self, binaries=None):
+        if self._lolbas_index is None:
+            raise LookupError("the catalog was loaded without a LOLBAS index")
+        selected, unknown, unresolved = select_lolbas_rules(self._lolbas_index, binaries)
+        if unknown:
+            raise KeyError(f"unknown LOLBIN(s): {', '.join(unknown)}")
+        positions = set()
+        for path in selected.values():
+            position = bisect.bisect_left(self._records, path, key=lambda rule: rule.path)
+            if position < len(self._records) and self._records[position].path == path:
+                positions.add(position)
+        return positions
+
+    def actor_techniques(self, name):
+        """
+        Return the ATT&CK technique IDs (e.g. 't1190') used by a threat actor name or alias.
+        """
+        if self._actor_table is None:
+            raise LookupError("the catalog was loaded without an ATT&CK actor table")
+        group_stix_id = self._actor_table["names"].get(name.lower())
+        if group_stix_id is None:
+            raise KeyError(f"threat actor '{name}' not found in the STIX data")
+        return [attack_id.lower() for attack_id in self._actor_table["groups"][group_stix_id]["techniques"]]
+
+    def by_technique(self, attack_ids):
+        """
+        Return the rules tagged with any of attack_ids or their sub-techniques.
+        """
+        return self._records_at(self._technique_positions(attack_ids))
+
+    def by_actor(self, name):
+        """
+        Return the rules tagged with a technique used by a threat actor.
+        """
+        return self.by_technique(self.actor_techniques(name))
+
+    def by_tactic(self, tactic):
+        """
+        Return the rules tagged with a tactic (e.g. 'initial-access').
+        """
+        return self._records_at(self._by_tactic.get(tactic.lower(), ()))
+
+    def by_product(self, product):
+        """
+        Return the rules whose logsource product is product (e.g. 'windows').
+        """
+        return self._records_at(self._by_product.get(product.lower(), ()))
+
+    def by_lolbin(self, binaries=None):
+        """
+        Return the rules referenced by the LOLBAS entries of binaries (e.g. ['certutil']),
+        or of all binaries when none are given. These are the rules --lolbin places,
+        untagged rules included.
+        """
+        return self._records_at(self._lolbin_positions(binaries))
+
+    def select(self, product=None, attack_ids=None, actor=None, tactic=None, lolbins=None, cost_budget=None):
+        """
+        Return {tactic: tuple of RuleRecord} for the rules matching all the given filters,
+        grouped like the chainrule tactic folders. attack_ids/actor filter by technique,
+        lolbins by LOLBAS references (an empty list meaning all binaries), and cost_budget
+        caps the total rule cost as in --cost-budget.
+
+        Like the technique selection of the CLI, only tagged rules of the product are
+        grouped, so lolbins narrows that selection. Unlike --lolbin, which places every
+        referenced rule regardless of product or tags, untagged rules are left out; use
+        by_lolbin for the rules --lolbin places.
+        """
+        attack_ids = [attack_id.lower() for attack_id in attack_ids or []]
+        if actor is not None:
+            attack_ids += self.actor_techniques(actor)
+        positions = None
+        if attack_ids:
+            positions = self._technique_positions(attack_ids)
+        if lolbins is not None:
+            lolbin_positions = self._lolbin_positions(lolbins)
+            positions = lolbin_positions if positions is None else positions & lolbin_positions
+        candidates = self._records if positions is None else self._records_at(positions)
+
+        product = product.lower() if product else None
+        tactic = tactic.lower() if tactic else None
+        matches = []
+        for rule in candidates:
+            tactic_tags = rule.tactic_folders(product, tactic)
+            if tactic_tags is not None:
+                matches.append((rule, tactic_tags))
+        if cost_budget is not None:
+            wrapped = [({"path": rule.path, "techniques": rule.techniques, "cost": rule.cost, "rule": rule}, tags)
+                       for rule, tags in matches]
+            kept, report = apply_cost_budget(wrapped, cost_budget, TechniqueMatcher(attack_ids) if attack_ids else None)
+            matches = [(record["rule"], tags) for record, tags in kept]
+
+        selection = {}
+        for rule, tactic_tags in matches:
+            for tactic_tag in tactic_tags:
+                selection.setdefault(tactic_tag, []).append(rule)
+        return {tactic_tag: tuple(rules) for tactic_tag, rules in selection.items()}
+
+    @staticmethod
+    def materialize(selection, chainrule_dir, dedup=False, link_mode="hardlink"):
+        """
+        Write a selection (see select) to chainrule_dir with its manifest, applying only
+        the differences from what the directory holds. Returns (tactic_to_files,
+        unique_matched_files) like process_sigma_files. Raises ValueError if chainrule_dir
+        is an existing directory that was not written by ThreatStalker.
+        """
+        check_output_dir(chainrule_dir, CHAINRULE_MANIFEST)
+        paths = {tactic: {rule.path for rule in rules} for tactic, rules in selection.items()}
+        return materialize_selection(chainrule_dir, paths, dedup, link_mode)
+
+    def footprint(self):
+        """
+        Return the bytes held by the rule records and indexes (shared strings and tuples
+        counted once; the actor table and LOLBAS index are not included).
+        """
+        seen = set()
+        total = 0
+
+        def add(obj):
+            nonlocal total
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                total += sys.getsizeof(obj)
+
+        add(self._records)
+        for rule in self._records:
+            add(rule)
+            for value in rule:
+                add(value)
+                if isinstance(value, tuple):
+                    for item in value:
+                        add(item)
+        for index in (self._by_technique, self._by_tactic, self._by_product):
+            add(index)
+            for key, positions in index.items():
+                add(key)
+                add(positions)
+        return total
@@ -0,0 +1,210 @@
+import heapq
+
+# Relative cost of matching one value under a Sigma field modifier; an exact match costs 1.
+MODIFIER_COSTS = {
+    "contains": 3.0,
+    "startswith": 2.0,
+    "endswith": 2.0,
+    "re": 10.0,
+    "cidr": 2.0,
+    "fieldref": 1.5,
+}
+# Modifiers that expand each value into several encoded variants, each matched separately.
+VARIANT_FACTORS = {
+    "base64offset": 3.0,
+    "windash": 2.0,
+    "wide": 2.0,
+    "utf16": 2.0,
+    "utf16le": 2.0,
+    "utf16be": 2.0,
+}
+# Unmodified values with wildcards are matched like 'contains'; bare keywords search the
+# whole event.
+WILDCARD_COST = 3.0
+KEYWORD_COST = 5.0
+# Fixed cost of looking up a field in an event.
+FIELD_COST = 1.0
+
+# How many events a logsource typically produces relative to a quiet channel; rules over
+# noisy logsources are evaluated against far more events.
+LOGSOURCE_WEIGHTS = {
+    "image_load": 4.0,
+    "process_creation": 3.0,
+    "process_access": 3.0,
+    "file_event": 3.0,
+    "file_access": 3.0,
+    "registry_event": 3.0,
+    "registry_set": 3.0,
+    "registry_add": 3.0,
+    "registry_delete": 3.0,
+    "network_connection": 3.0,
+    "ps_script": 2.5,
+    "ps_module": 2.5,
+    "dns_query": 2.0,
+    "pipe_created": 1.5,
+    "sysmon": 3.0,
+    "powershell": 2.5,
+    "security": 2.0,
+    "system": 1.0,
+}
+DEFAULT_LOGSOURCE_WEIGHT = 1.5
+
+# Sidecar file in the chainrule directory reporting a budget-capped selection.
+BUDGET_REPORT = "chainrule_budget.json"
+
+def _value_cost(value, modifiers):
+    if any(modifier in MODIFIER_COSTS for modifier in modifiers):
+        cost = max(MODIFIER_COSTS.get(modifier, 1.0) for modifier in modifiers)
+    elif isinstance(value, str) and ("*" in value or "?" in value):
+        cost = WILDCARD_COST
+    else:
+        cost = 1.0
+    for modifier in modifiers:
+        cost *= VARIANT_FACTORS.get(modifier, 1.0)
+    return cost
+
+def _selection_cost(node):
+    """
+    Return the cost of one detection item: a field map, a list of field maps (OR'ed) or
+    keywords.
+    """
+    if isinstance(node, dict):
+        cost = 0.0
+        for key, values in node.items():
+            modifiers = [modifier.lower() for modifier in str(key).split("|")[1:]]
+            values = values if isinstance(values, list) else [values]
+            cost += FIELD_COST + sum(_value_cost(value, modifiers) for value in values)
+        return cost
+    if isinstance(node, list):
+        return sum(_selection_cost(item) if isinstance(item, (dict, list)) else KEYWORD_COST for item in node)
+    return KEYWORD_COST
+
+def estimate_rule_cost(detection, logsource):
+    """
+    Return a static estimate of the cost of evaluating a rule: the cost of its detection
+    items (fields, values and modifiers, with regexes and substring matches weighted above
+    exact matches) scaled by how noisy its logsource is. Costs are relative and comparable
+    between rules, not times.
+    """
+    cost = 0.0
+    if isinstance(detection, dict):
+        for name, node in detection.items():
+            if name in ("condition", "timeframe"):
+                continue
+            cost += _selection_cost(node)
+    if not isinstance(logsource, dict):
+        logsource = {}
+    weight = DEFAULT_LOGSOURCE_WEIGHT
+    for key in ("category", "service"):
+        value = logsource.get(key)
+        if isinstance(value, str) and value.lower() in LOGSOURCE_WEIGHTS:
+            weight = LOGSOURCE_WEIGHTS[value.lower()]
+            break
+    return round(max(cost, 1.0) * weight, 2)
+
+def _greedy_cover(entries, budget, seed=None):
+    """
+    Return (kept flags, covered techniques, spent) for a greedy pick of entries by newly
+    covered techniques per unit of cost, starting from the entry at index seed if given.
+    """
+    kept = [False] * len(entries)
+    covered = set()
+    spent = 0.0
+    if seed is not None:
+        kept[seed] = True
+        covered |= entries[seed][2]
+        spent += entries[seed][3]
+    heap = [(-len(covers - covered) / cost, record["path"], i, len(covers - covered))
+            for i, (record, _, covers, cost) in enumerate(entries) if covers - covered and not kept[i]]
+    heapq.heapify(heap)
+    while heap:
+        _, path, i, gain = heapq.heappop(heap)
+        record, _, covers, cost = entries[i]
+        # Gains only shrink as coverage grows, so a popped entry is re-queued when stale
+        current = len(covers - covered)
+        if current == 0:
+            continue
+        if current < gain:
+            heapq.heappush(heap, (-current / cost, path, i, current))
+            continue
+        if spent + cost > budget:
+            continue
+        kept[i] = True
+        spent += cost
+        covered |= covers
+    return kept, covered, spent
+
+def apply_cost_budget(matches, budget, matcher=None):
+    """
+    Keep the (record, tactic folders) matches that cover the most techniques within a
+    total rule cost of budget.
+
+    Rules are picked greedily by newly covered techniques per unit of cost; the pick
+    seeded with the affordable rule covering the most techniques is used instead when it
+    covers more. The remaining budget is then spent on the cheapest of the other rules.
+    A technique is a requested ATT&CK ID matched by matcher, or each technique tag of the
+    rule when no matcher is given. Returns (kept matches, report).
+    """
+    entries = []
+    for record, tactic_tags in matches:
+        if matcher is not None:
+            covers = matcher.matched_ids(record["techniques"])
+        else:
+            covers = set(record["techniques"])
+        entries.append((record, tactic_tags, frozenset(covers), record.get("cost", 1.0)))
+
+    kept, covered, spent = _greedy_cover(entries, budget)
+    affordable = [i for i, entry in enumerate(entries) if entry[3] <= budget and entry[2]]
+    if affordable:
+        seed = max(affordable, key=lambda i: (len(entries[i][2]), -entries[i][3]))
+        seeded = _greedy_cover(entries, budget, seed)
+        if len(seeded[1]) > len(covered):
+            kept, covered, spent = seeded
+
+    # Spend what is left on further rules for the covered techniques, cheapest first
+    for i in sorted((i for i in range(len(entries)) if not kept[i]), key=lambda i: (entries[i][3], entries[i][0]["path"])):
+        if spent + entries[i][3] <= budget:
+            kept[i] = True
+            spent += entries[i][3]
+
+    techniques = {}
+    for i, (record, _, covers, cost) in enumerate(entries):
+        for technique in covers:
+            stats = techniques.setdefault(technique, {"rules": 0, "kept_rules": 0, "kept_cost": 0.0, "cheapest_cost": cost})
+            stats["rules"] += 1
+            stats["cheapest_cost"] = min(stats["cheapest_cost"], cost)
+            if kept[i]:
+                stats["kept_rules"] += 1
+                stats["kept_cost"] += cost
+    report = {
+        "budget": budget,
+        "spent": round(spent, 2),
+        "total_cost": round(sum(entry[3] for entry in entries), 2),
+        "rules": {"kept": sum(kept), "total": len(entries)},
+        "kept_techniques": {
+            technique: {"rules": stats["kept_rules"], "cost": round(stats["kept_cost"], 2)}
+            for technique, stats in sorted(techniques.items()) if stats["kept_rules"]
+        },
+        "dropped_techniques": {
+            technique: {"rules": stats["rules"], "cheapest_cost": stats["cheapest_cost"]}
+            for technique, stats in sorted(techniques.items()) if not stats["kept_rules"]
+        },
+        "dropped_rules": sorted(entries[i][0]["path"] for i in range(len(entries)) if not kept[i]),
+    }
+    return [(record, tactic_tags) for i, (record, tactic_tags, _, _) in enumerate(entries) if kept[i]], report
+
+def print_budget_report(report):
+    """
+    Print the cost and the kept and dropped techniques of a budget-capped selection.
+    """
+    print(f"\nCost budget: {report['budget']:g} (spent {report['spent']:g} of {report['total_cost']:g})")
+    print(f"Rules kept: {report['rules']['kept']} of {report['rules']['total']}")
+    kept = report["kept_techniques"]
+    dropped = report["dropped_techniques"]
+    print(f"Techniques kept: {len(kept)} of {len(kept) + len(dropped)}")
+    for technique, stats in kept.items():
+        print(f"  {technique}: {stats['rules']} rules, cost {stats['cost']:g}")
+    if dropped:
+        print(f"Techniques dropped: {len(dropped)}")
+        for technique, stats in dropped.items():
+            print(f"  {technique}: {stats['rules']} rules, cheapest {stats['cheapest_cost']:g}")
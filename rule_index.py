@@ -0,0 +1,295 @@
+import os
+import re
+import json
+import metrics
+from bisect import bisect_left
+from yaml_loader import load_yaml_files
+from rule_cost import estimate_rule_cost
+
+# Bump whenever the layout of an index record changes so stale indexes are rebuilt.
+INDEX_VERSION = 4
+
+TECHNIQUE_PATTERN = re.compile(r"^attack\.t\d+(\.\d+)?$", re.IGNORECASE)
+IGNORE_PATTERN = re.compile(r"^attack\.[sg]\d+$", re.IGNORECASE)
+
+def get_cache_dir():
+    """
+    Return the directory used for ThreatStalker's on-disk caches, creating it if needed.
+    """
+    cache_dir = os.path.join(os.getcwd(), "cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def parse_attack_tags(tags):
+    """
+    Split a rule's tag list into (techniques, tactics).
+
+    Technique tags such as 'attack.t1059.001' become 't1059.001'; any other 'attack.' tag
+    becomes a tactic. Tags like 'attack.sNNNN' or 'attack.gNNNN' are ignored.
+    """
+    techniques = []
+    tactics = []
+    for tag in tags:
+        if isinstance(tag, str) and tag.startswith("attack."):
+            if IGNORE_PATTERN.match(tag):
+                continue
+            value = tag[len("attack."):].lower()
+            if TECHNIQUE_PATTERN.match(tag):
+                techniques.append(value)
+            else:
+                tactics.append(value)
+    return techniques, tactics
+
+def _as_lower_list(value):
+    if isinstance(value, list):
+        return [v.lower() for v in value if isinstance(v, str)]
+    if isinstance(value, str):
+        return [value.lower()]
+    return []
+
+def _as_lower_str(value):
+    return value.lower() if isinstance(value, str) else None
+
+def _collect_field_values(node, field, values):
+    """
+    Collect the values of every `field` key found in a rule's detection section.
+    """
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == field:
+                for item in value if isinstance(value, list) else [value]:
+                    if isinstance(item, (str, int)):
+                        values.add(str(item))
+            else:
+                _collect_field_values(value, field, values)
+    elif isinstance(node, list):
+        for item in node:
+            _collect_field_values(item, field, values)
+    return values
+
+def extract_rule_metadata(data):
+    """
+    Reduce a parsed Sigma rule to the fields rule selection needs.
+    """
+    if not isinstance(data, dict):
+        data = {}
+    tags = data.get("tags")
+    tagged = isinstance(tags, list)
+    techniques, tactics = parse_attack_tags(tags) if tagged else ([], [])
+    logsource = data.get("logsource")
+    if not isinstance(logsource, dict):
+        logsource = {}
+    return {
+        "id": data.get("id") if isinstance(data.get("id"), str) else None,
+        "tagged": tagged,
+        "techniques": techniques,
+        "tactics": tactics,
+        "logsource": {
+            "product": _as_lower_list(logsource.get("product")),
+            "category": _as_lower_str(logsource.get("category")),
+            "service": _as_lower_str(logsource.get("service")),
+        },
+        "level": _as_lower_str(data.get("level")),
+        "status": _as_lower_str(data.get("status")),
+        # hayabusa-rules conversions pin each rule to its Channel/EventID in the detection
+        "channels": sorted(_collect_field_values(data.get("detection"), "Channel", set())),
+        "event_ids": sorted(_collect_field_values(data.get("detection"), "EventID", set())),
+        "cost": estimate_rule_cost(data.get("detection"), logsource),
+    }
+
+def scan_rule_files(rules_dir):
+    """
+    Yield (relative path, os.stat_result) for every .yml file below rules_dir.
+    """
+    for root, dirs, files in os.walk(rules_dir):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(".yml"):
+                file_path = os.path.join(root, file)
+                try:
+                    st = os.stat(file_path)
+                except OSError as e:
+                    print(f"Error reading file {file_path}: {e}")
+                    continue
+                yield os.path.relpath(file_path, rules_dir), st
+
+def index_techniques(items, postings=None):
+    """
+    Add the (key, record) pairs of items to the technique postings {technique: set of keys}
+    and return them.
+    """
+    if postings is None:
+        postings = {}
+    for key, record in items:
+        for tech in record["techniques"]:
+            postings.setdefault(tech, set()).add(key)
+    return postings
+
+def _read_index(index_path, rules_dir):
+    """
+    Return the (entries, technique postings) of a saved index, or empty ones if it is
+    missing or stale.
+    """
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}, {}
+    if index.get("version") != INDEX_VERSION or index.get("root") != os.path.abspath(rules_dir):
+        return {}, {}
+    return index.get("rules", {}), {tech: set(keys) for tech, keys in index.get("techniques", {}).items()}
+
+def _write_index(index_path, rules_dir, entries, postings):
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "version": INDEX_VERSION,
+                "root": os.path.abspath(rules_dir),
+                "rules": entries,
+                "techniques": {tech: sorted(keys) for tech, keys in sorted(postings.items())},
+            },
+            f,
+            separators=(",", ":"),
+        )
+    os.replace(tmp_path, index_path)
+
+def iter_rule_index(rules_dir, index_path=None, workers=None, attack_ids=None):
+    """
+    Yield (relative path, record) for every .yml rule below rules_dir, in path order.
+
+    Records are served from a persistent index keyed by each file's relative path, size and
+    mtime; only new or modified files are parsed (across `workers` processes), each exactly
+    once, and removed files are dropped. The index also keeps the technique postings
+    {technique: relative paths}, which are updated for the changed files only. If
+    attack_ids is given, the postings are looked up (see TechniqueIndex) and only the
+    rules tagged with one of the IDs or their sub-techniques are yielded. The refreshed
+    index is saved once the last record has been yielded. Each record holds 'path'
+    (absolute), 'id', 'tagged', 'techniques', 'tactics', 'logsource', 'level', 'status',
+    'channels', 'event_ids' and 'cost' (see rule_cost); files that fail to parse are
+    reported and left out.
+    """
+    if index_path is None:
+        index_path = os.path.join(get_cache_dir(), "rule_index.json")
+    cached, postings = _read_index(index_path, rules_dir)
+
+    entries = {}
+    stale = []
+    for rel_path, st in scan_rule_files(rules_dir):
+        entry = cached.get(rel_path)
+        if entry is None or entry["mtime_ns"] != st.st_mtime_ns or entry["size"] != st.st_size:
+            stale.append(rel_path)
+            entry = {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+        entries[rel_path] = entry
+    changed = bool(stale) or len(entries) != len(cached)
+    metrics.cache("rule_index", len(entries) - len(stale), len(stale))
+    metrics.count("rule_files_parsed", len(stale))
+    metrics.count("rule_bytes_parsed", sum(entries[rel_path]["size"] for rel_path in stale))
+
+    # Withdraw the postings of modified and removed files, then post the reparsed ones
+    if changed:
+        for rel_path, entry in cached.items():
+            if entries.get(rel_path) is not entry:
+                for tech in entry.get("meta", {}).get("techniques", ()):
+                    keys = postings.get(tech)
+                    if keys is not None:
+                        keys.discard(rel_path)
+                        if not keys:
+                            del postings[tech]
+    del cached
+    stale_paths = [os.path.join(rules_dir, rel_path) for rel_path in stale]
+    results = load_yaml_files(stale_paths, workers=workers, transform=extract_rule_metadata)
+    for (file_path, meta, error), rel_path in zip(results, stale):
+        if error is not None:
+            entries[rel_path]["error"] = error
+        else:
+            entries[rel_path]["meta"] = meta
+            index_techniques([(rel_path, meta)], postings)
+
+    candidates = TechniqueIndex(postings).select(attack_ids) if attack_ids else None
+    for rel_path, entry in entries.items():
+        file_path = os.path.join(rules_dir, rel_path)
+        if "error" in entry:
+            print(f"Error reading file {file_path}: {entry['error']}")
+            continue
+        if candidates is not None and rel_path not in candidates:
+            continue
+        record = dict(entry["meta"])
+        record["path"] = file_path
+        yield rel_path, record
+
+    if changed:
+        try:
+            _write_index(index_path, rules_dir, entries, postings)
+        except OSError as e:
+            print(f"Warning: failed to write rule index {index_path}: {e}")
+
+def load_rule_index(rules_dir, index_path=None, workers=None):
+    """
+    Return {relative path: record} for every .yml rule below rules_dir (see iter_rule_index).
+    """
+    return dict(iter_rule_index(rules_dir, index_path, workers))
+
+class TechniqueIndex:
+    """
+    Inverted index from technique IDs (e.g. 't1059', 't1059.001') to the keys of the rules
+    tagged with them, as built by index_techniques or saved with the rule index.
+
+    Lookups use prefix semantics, like TechniqueMatcher, so a parent technique also
+    selects its sub-techniques. A lookup only touches the distinct technique IDs sharing
+    the prefix, never the rules themselves.
+    """
+
+    def __init__(self, postings):
+        self._postings = postings
+        self._techniques = sorted(postings)
+
+    def lookup(self, attack_id):
+        """
+        Return the set of rule keys tagged with a technique starting with attack_id.
+        """
+        attack_id = attack_id.lower()
+        matched = set()
+        i = bisect_left(self._techniques, attack_id)
+        while i < len(self._techniques) and self._techniques[i].startswith(attack_id):
+            matched |= self._postings[self._techniques[i]]
+            i += 1
+        return matched
+
+    def select(self, attack_ids):
+        """
+        Return the union of lookup() over all attack_ids.
+        """
+        selected = set()
+        for attack_id in attack_ids:
+            selected |= self.lookup(attack_id)
+        return selected
+
+class TechniqueMatcher:
+    """
+    Match a rule's technique IDs against a list of ATT&CK IDs.
+
+    Matching uses prefix semantics, like the original 'tech.startswith(aid)' filter, so a
+    parent technique also selects its sub-techniques. Each technique is checked by looking
+    up its prefixes in a set, so the cost per rule does not grow with the number of IDs.
+    """
+
+    def __init__(self, attack_ids):
+        self._attack_ids = {attack_id.lower() for attack_id in attack_ids}
+
+    def matches(self, techniques):
+        """
+        Return True if any of techniques starts with one of the attack IDs.
+        """
+        for tech in techniques:
+            for end in range(1, len(tech) + 1):
+                if tech[:end] in self._attack_ids:
+                    return True
+        return False
+
+    def matched_ids(self, techniques):
+        """
+        Return the set of attack IDs that any of techniques starts with.
+        """
+        return {tech[:end] for tech in techniques for end in range(1, len(tech) + 1)
+                if tech[:end] in self._attack_ids}
@@ -1,177 +1,238 @@
 import os
-import shutil
-import re
-import yaml
+import json
+import metrics
+from rule_index import iter_rule_index, TechniqueMatcher
+from materializer import materialize_rules
+from rule_cost import BUDGET_REPORT, apply_cost_budget, print_budget_report
 
-def clean_chainrule_directory(chainrule_dir):
+# Sidecar file in the chainrule directory recording each rule's source and tactics.
+CHAINRULE_MANIFEST = "chainrule_manifest.json"
+
+# MITRE ATT&CK enterprise tactics in kill-chain order.
+TACTIC_ORDER = [
+    "reconnaissance",
+    "resource-development",
+    "initial-access",
+    "execution",
+    "persistence",
+    "privilege-escalation",
+    "defense-evasion",
+    "credential-access",
+    "discovery",
+    "lateral-movement",
+    "collection",
+    "command-and-control",
+    "exfiltration",
+    "impact",
+]
+
+def order_tactics(tactics):
     """
-    If the chainrule directory exists, remove it and recreate a new one.
+    Return tactics in kill-chain order, followed by any other tactics alphabetically.
     """
-    if os.path.exists(chainrule_dir):
-        shutil.rmtree(chainrule_dir)
-    os.makedirs(chainrule_dir)
+    return [tactic for tactic in TACTIC_ORDER if tactic in tactics] + \
+        sorted(tactic for tactic in tactics if tactic not in TACTIC_ORDER)
 
-def process_sigma_files(sigma_dir, chainrule_dir, attack_ids, product, tactic_filter=None):
+def print_tactic_counts(tactic_counts, tactic_filter=None):
     """
-    From specified subdirectories within the sigma directory, copy YAML files
-    that match the given attackIDs and product to the chainrule directory, organized by tactic.
-    
-    Additionally, if tactic_filter is provided, only extract files that contain a tag
-    matching "attack.<tactic_filter>".
-    
-    Note: attack tags like 'attack.sNNNN' or 'attack.gNNNN' are ignored.
-    If attack_ids is empty (i.e. filtering solely by tactics), the technique matching is bypassed.
+    Print '<tactic>: <count> files' lines in kill-chain order, or only the line for
+    tactic_filter when one is given.
     """
-    subdirs = ["builtin"]
-    tactic_to_files = {}
-    unique_matched_files = set()
-    technique_pattern = re.compile(r"^attack\.t\d+(\.\d+)?$", re.IGNORECASE)
-    ignore_pattern = re.compile(r"^attack\.[sg]\d+$", re.IGNORECASE)
+    if tactic_filter is not None:
+        print(f"{tactic_filter}: {tactic_counts.get(tactic_filter, 0)} files")
+        return
+    for tactic in order_tactics(tactic_counts):
+        print(f"{tactic}: {tactic_counts[tactic]} files")
+
+def match_rule_tactics(record, product, tactic_filter=None):
+    """
+    Return the tactic folders a rule record belongs in, or None if the rule does not
+    match the product/tactic filters. Technique matching is done separately through
+    a TechniqueMatcher.
+    """
+    if not record["tagged"]:
+        return None
 
+    # Check that the logsource product field matches the specified product
+    if product not in record["logsource"]["product"]:
+        return None
+
+    # Tactic tags (attack. tags that are not technique tags)
+    tactic_tags = list(record["tactics"])
+    if not tactic_tags:
+        tactic_tags = ["misc"]
+
+    # If tactic_filter is provided,ファイルにtactic_filterが含まれなければスキップ
+    if tactic_filter is not None:
+        if tactic_filter not in tactic_tags:
+            return None
+        # tactics指定時は、コピー先フォルダはtactic_filterのみに固定
+        tactic_tags = [tactic_filter]
+    return tactic_tags
+
+def discover_rule_records(sigma_dir, subdirs=("builtin",), workers=None, attack_ids=None):
+    """
+    Discover and parse stage: yield the index record of every rule in the given
+    subdirectories of sigma_dir. Each rule file is parsed at most once, and only when it
+    changed since the index was last written (see iter_rule_index). With attack_ids, only
+    the rules found for them in the saved technique postings are yielded.
+    """
     for sub in subdirs:
         sub_dir_path = os.path.join(sigma_dir, sub)
         if not os.path.exists(sub_dir_path):
             print(f"Error: '{sub_dir_path}' directory does not exist.")
             continue
+        for rel_path, record in iter_rule_index(sub_dir_path, workers=workers, attack_ids=attack_ids):
+            yield record
+
+def filter_rule_records(records, attack_ids, product, tactic_filter=None):
+    """
+    Filter stage: yield (record, tactic folders) for the records matching the technique,
+    product and tactic filters. If attack_ids is empty, technique matching is bypassed.
+    Records discovered with the same attack_ids are already narrowed to the candidates
+    through the technique postings, so the technique check only visits those.
+    """
+    matcher = TechniqueMatcher(attack_ids) if attack_ids else None
+    for record in records:
+        if matcher is not None and not matcher.matches(record["techniques"]):
+            continue
+        tactic_tags = match_rule_tactics(record, product, tactic_filter)
+        if tactic_tags is not None:
+            yield record, tactic_tags
 
-        for root, dirs, files in os.walk(sub_dir_path):
-            for file in files:
-                if file.endswith(".yml"):
-                    file_path = os.path.join(root, file)
-                    try:
-                        with open(file_path, "r", encoding="utf-8") as f:
-                            data = yaml.safe_load(f)
-                    except Exception as e:
-                        print(f"Error reading file {file_path}: {e}")
-                        continue
-
-                    if "tags" not in data or not isinstance(data["tags"], list):
-                        continue
-                    tags = data["tags"]
-
-                    # If attack_ids is provided, perform technique tag matching;
-                    # otherwise (empty attack_ids) bypass technique matching.
-                    technique_match = False
-                    if attack_ids:
-                        for tag in tags:
-                            if isinstance(tag, str) and tag.startswith("attack."):
-                                if ignore_pattern.match(tag):
-                                    continue
-                                if technique_pattern.match(tag):
-                                    tech = tag[len("attack."):].lower()
-                                    for aid in attack_ids:
-                                        if tech.startswith(aid):
-                                            technique_match = True
-                                            break
-                            if technique_match:
-                                break
-                    else:
-                        technique_match = True  # bypass filtering by attack_ids
-
-                    if not technique_match:
-                        continue
-
-                    # Check that the logsource product field matches the specified product
-                    product_match = False
-                    if "logsource" in data:
-                        if "product" in data["logsource"]:
-                            prod_field = data["logsource"]["product"]
-                            if isinstance(prod_field, list):
-                                for prod in prod_field:
-                                    if isinstance(prod, str) and prod.lower() == product:
-                                        product_match = True
-                                        break
-                            elif isinstance(prod_field, str):
-                                if prod_field.lower() == product:
-                                    product_match = True
-                    if not product_match:
-                        continue
-
-                    # Extract tactic tags (attack. tags that are not technique tags)
-                    tactic_tags = []
-                    for tag in tags:
-                        if isinstance(tag, str) and tag.startswith("attack."):
-                            if ignore_pattern.match(tag):
-                                continue
-                            if not technique_pattern.match(tag):
-                                tactic = tag[len("attack."):].lower()
-                                tactic_tags.append(tactic)
-                    if not tactic_tags:
-                        tactic_tags = ["misc"]
-
-                    # If tactic_filter is provided,ファイルにtactic_filterが含まれなければスキップ
-                    if tactic_filter is not None:
-                        if tactic_filter not in tactic_tags:
-                            continue
-                        # tactics指定時は、コピー先フォルダはtactic_filterのみに固定
-                        tactic_tags = [tactic_filter]
-
-                    unique_matched_files.add(file_path)
-
-                    # Copy the file into the appropriate tactic folder(s)
-                    for tactic in tactic_tags:
-                        tactic_dir = os.path.join(chainrule_dir, tactic)
-                        os.makedirs(tactic_dir, exist_ok=True)
-                        dst = os.path.join(tactic_dir, os.path.basename(file_path))
-                        try:
-                            shutil.copy2(file_path, dst)
-                            if tactic not in tactic_to_files:
-                                tactic_to_files[tactic] = set()
-                            tactic_to_files[tactic].add(file_path)
-                        except Exception as e:
-                            print(f"Error copying file {file_path}: {e}")
+def collect_selection(matches):
+    """
+    Return {tactic: set of rule paths} for (record, tactic folders) pairs. Only the paths
+    of selected rules are kept, not the records themselves.
+    """
+    selection = {}
+    for record, tactic_tags in matches:
+        for tactic in tactic_tags:
+            selection.setdefault(tactic, set()).add(record["path"])
+    return selection
 
+def plan_chainrule_layout(selection, dedup=False):
+    """
+    Return the desired chainrule layout {relative path: source path} for a selection.
+    By default each rule lands in every <tactic>/ folder it was selected under; with
+    dedup=True each rule is placed exactly once at the top level.
+    """
+    desired = {}
+    for tactic in sorted(selection):
+        for file_path in sorted(selection[tactic]):
+            basename = os.path.basename(file_path)
+            rel_path = basename if dedup else os.path.join(tactic, basename)
+            desired.setdefault(rel_path, file_path)
+    return desired
+
+def build_chainrule_manifest(placed, selection, dedup=False):
+    """
+    Build the sidecar manifest recording, for each materialized rule (by file name),
+    its source path and the tactics it was selected under. Only rules that were
+    actually placed (see materialize_rules) are included.
+    """
+    rules = {}
+    for tactic in sorted(selection):
+        for file_path in sorted(selection[tactic]):
+            basename = os.path.basename(file_path)
+            rel_path = basename if dedup else os.path.join(tactic, basename)
+            if placed.get(rel_path) != file_path:
+                continue
+            entry = rules.setdefault(basename, {"source": file_path, "tactics": []})
+            entry["tactics"].append(tactic)
+    return {"layout": "dedup" if dedup else "tactic", "rules": rules}
+
+def _summarize_manifest(manifest):
+    tactic_to_files = {}
+    unique_matched_files = set()
+    for entry in manifest.get("rules", {}).values():
+        unique_matched_files.add(entry["source"])
+        for tactic in entry["tactics"]:
+            tactic_to_files.setdefault(tactic, set()).add(entry["source"])
     return tactic_to_files, unique_matched_files
 
+def load_chainrule_manifest(chainrule_dir):
+    """
+    Read the chainrule manifest and return (tactic_to_files, unique_matched_files),
+    or (None, None) if the directory has no manifest.
+    """
+    try:
+        with open(os.path.join(chainrule_dir, CHAINRULE_MANIFEST), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None, None
+    return _summarize_manifest(manifest)
+
+def materialize_selection(chainrule_dir, selection, dedup=False, link_mode="hardlink", extra_files=None):
+    """
+    Bring chainrule_dir in line with a {tactic: set of rule paths} selection, together
+    with its manifest, and return (tactic_to_files, unique_matched_files) for the rules
+    actually placed.
+
+    Only rules that changed since the previous run are written (see materialize_rules).
+    extra_files optionally maps (tactic_to_files, unique_matched_files) to further
+    {relative path: text} files to publish alongside the rules.
+    """
+    def generated_files(placed):
+        manifest = build_chainrule_manifest(placed, selection, dedup)
+        files = {CHAINRULE_MANIFEST: json.dumps(manifest, indent=2)}
+        if extra_files:
+            files.update(extra_files(*_summarize_manifest(manifest)))
+        return files
+
+    desired = plan_chainrule_layout(selection, dedup)
+    placed, stats = materialize_rules(chainrule_dir, desired, link_mode, generated_files)
+    print(f"chainrule: {stats['added']} added, {stats['removed']} removed, {stats['unchanged']} unchanged")
+    return _summarize_manifest(build_chainrule_manifest(placed, selection, dedup))
+
+def process_sigma_files(sigma_dir, chainrule_dir, attack_ids, product, tactic_filter=None, workers=None, dedup=False,
+                        link_mode="hardlink", records=None, cost_budget=None):
+    """
+    From specified subdirectories within the sigma directory, place YAML files
+    that match the given attackIDs and product in the chainrule directory, organized by tactic.
+    
+    Additionally, if tactic_filter is provided, only extract files that contain a tag
+    matching "attack.<tactic_filter>".
+    
+    Note: attack tags like 'attack.sNNNN' or 'attack.gNNNN' are ignored.
+    If attack_ids is empty (i.e. filtering solely by tactics), the technique matching is bypassed.
+    Rules that changed since the last run are parsed across `workers` processes.
+    With dedup=True each rule is written once and the tactic grouping is only kept in
+    the chainrule manifest, which is written in either mode. Files are hardlinked, symlinked
+    or copied according to link_mode, and only the differences from the previous run are
+    applied.
+
+    Rules stream through discover_rule_records -> filter_rule_records -> collect_selection
+    -> materialize_selection, and the returned summary is built from the manifest held in
+    memory, so the written rules are never read back. With attack_ids, the discover stage
+    only yields the candidates found in the technique postings of the rule index. records
+    optionally supplies already loaded index records (e.g. held by the daemon) in place of
+    the discover stage.
+
+    With cost_budget, only the rules keeping the most techniques covered within that total
+    estimated cost are placed (see rule_cost.apply_cost_budget); the kept and dropped
+    techniques are printed and recorded in chainrule_budget.json.
+    """
+    extra_files = None
+    with metrics.stage("scan_filter"):
+        if records is None:
+            records = discover_rule_records(sigma_dir, ["builtin"], workers, attack_ids)
+        matches = filter_rule_records(records, attack_ids, product, tactic_filter)
+        if cost_budget is not None:
+            matcher = TechniqueMatcher(attack_ids) if attack_ids else None
+            matches, report = apply_cost_budget(matches, cost_budget, matcher)
+            print_budget_report(report)
+            extra_files = lambda t, u: {BUDGET_REPORT: json.dumps(report, indent=2)}
+        selection = collect_selection(matches)
+    with metrics.stage("materialize"):
+        return materialize_selection(chainrule_dir, selection, dedup, link_mode, extra_files)
+
 def print_summary(tactic_to_files, unique_matched_files, tactic_filter=None):
     """
     Print a summary of the number of files per tactic and total unique rules.
-    When tactic_filter is provided, only show that tactic.
-    Otherwise, display in the following fixed order:
-    
-      reconnaissance
-      resource-development
-      initial-access
-      execution
-      persistence
-      privilege-escalation
-      defense-evasion
-      credential-access
-      discovery
-      lateral-movement
-      collection
-      command-and-control
-      exfiltration
-      impact
+    When tactic_filter is provided, only show that tactic; otherwise tactics are shown
+    in kill-chain order (TACTIC_ORDER), followed by any others alphabetically.
     """
     print("\nMITRE Tactic Summary:\n")
-    order = [
-        "reconnaissance",
-        "resource-development",
-        "initial-access",
-        "execution",
-        "persistence",
-        "privilege-escalation",
-        "defense-evasion",
-        "credential-access",
-        "discovery",
-        "lateral-movement",
-        "collection",
-        "command-and-control",
-        "exfiltration",
-        "impact"
-    ]
-    if tactic_filter is not None:
-        count = len(tactic_to_files.get(tactic_filter, []))
-        print(f"{tactic_filter}: {count} files")
-    else:
-        for tactic in order:
-            if tactic in tactic_to_files:
-                count = len(tactic_to_files[tactic])
-                print(f"{tactic}: {count} files")
-        # もしorderにないフォルダがあればアルファベット順で表示
-        for tactic in sorted(tactic_to_files.keys()):
-            if tactic not in order:
-                count = len(tactic_to_files[tactic])
-                print(f"{tactic}: {count} files")
+    print_tactic_counts({tactic: len(files) for tactic, files in tactic_to_files.items()}, tactic_filter)
     print(f"\nTotal unique rules: {len(unique_matched_files)}\n\n")
@@ -1,38 +1,180 @@
+import os
 import json
-from mitreattack.stix20 import MitreAttackData
+import hashlib
+import metrics
+from rule_index import get_cache_dir
+
+# Bump whenever the layout of the compiled actor table changes.
+ACTOR_TABLE_VERSION = 1
+
+def _is_active(obj):
+    """
+    Return True if a STIX object is neither revoked nor deprecated.
+    """
+    return obj.get("x_mitre_deprecated", False) is False and obj.get("revoked", False) is False
+
+def _get_attack_id(obj):
+    external_references = obj.get("external_references")
+    if external_references:
+        attack_source = external_references[0]
+        if attack_source.get("external_id") and attack_source.get("source_name") == "mitre-attack":
+            return attack_source["external_id"]
+    return None
+
+def _hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def compile_actor_table(stix_file):
+    """
+    Reduce an enterprise-attack STIX bundle to a compact actor lookup table.
+
+    The table maps every intrusion-set name and alias (lowercased) to the group's STIX ID,
+    and every group to the ATT&CK IDs of the techniques it uses directly or through campaigns
+    attributed to it, following the same revoked/deprecated filtering as
+    MitreAttackData.get_techniques_used_by_group.
+    """
+    with open(stix_file, "r", encoding="utf-8") as f:
+        bundle = json.load(f)
+    objects = bundle.get("objects", [])
+
+    techniques = {}
+    campaigns = set()
+    groups = {}
+    for obj in objects:
+        obj_type = obj.get("type")
+        if obj_type == "attack-pattern" and _is_active(obj):
+            attack_id = _get_attack_id(obj)
+            if attack_id:
+                techniques[obj["id"]] = (attack_id, obj.get("name", ""))
+        elif obj_type == "campaign" and _is_active(obj):
+            campaigns.add(obj["id"])
+        elif obj_type == "intrusion-set":
+            groups[obj["id"]] = obj
+
+    group_uses = {}
+    campaign_uses = {}
+    campaign_groups = {}
+    for obj in objects:
+        if obj.get("type") != "relationship" or not _is_active(obj):
+            continue
+        source_ref = obj.get("source_ref", "")
+        target_ref = obj.get("target_ref", "")
+        relationship_type = obj.get("relationship_type")
+        if relationship_type == "uses" and target_ref in techniques:
+            if source_ref.startswith("intrusion-set--"):
+                group_uses.setdefault(source_ref, []).append(target_ref)
+            elif source_ref in campaigns:
+                campaign_uses.setdefault(source_ref, []).append(target_ref)
+        elif relationship_type == "attributed-to" and source_ref in campaigns:
+            if target_ref.startswith("intrusion-set--"):
+                campaign_groups.setdefault(target_ref, []).append(source_ref)
+
+    table_groups = {}
+    names = {}
+    aliases = {}
+    for stix_id, group in groups.items():
+        used = list(group_uses.get(stix_id, []))
+        for campaign_id in campaign_groups.get(stix_id, []):
+            used.extend(campaign_uses.get(campaign_id, []))
+        attack_ids = list(dict.fromkeys(techniques[t][0] for t in used))
+        table_groups[stix_id] = {"name": group.get("name", ""), "techniques": attack_ids}
+        # Prefer active groups when a retired group shares a name or alias with a current one.
+        name = group.get("name", "").lower()
+        if name and (name not in names or _is_active(group)):
+            names[name] = stix_id
+        for alias in group.get("aliases", []) or []:
+            alias = alias.lower()
+            if alias and (alias not in aliases or _is_active(group)):
+                aliases[alias] = stix_id
+    # Exact group names take precedence over aliases.
+    aliases.update(names)
+
+    return {
+        "version": ACTOR_TABLE_VERSION,
+        "techniques": {attack_id: name for attack_id, name in techniques.values()},
+        "groups": table_groups,
+        "names": aliases,
+    }
+
+def load_actor_table(stix_file, table_path=None):
+    """
+    Return the compiled actor table for stix_file, compiling it on first use.
+
+    The table is cached on disk keyed by the bundle's SHA-256. The file is only re-hashed
+    when its size or mtime changed, and only recompiled when the hash changed.
+    """
+    if table_path is None:
+        table_path = os.path.join(get_cache_dir(), "attack_actors.json")
+    st = os.stat(stix_file)
+
+    table = None
+    try:
+        with open(table_path, "r", encoding="utf-8") as f:
+            table = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if table is not None and table.get("version") == ACTOR_TABLE_VERSION:
+        if table.get("size") == st.st_size and table.get("mtime_ns") == st.st_mtime_ns:
+            metrics.cache("actor_table", 1, 0)
+            return table
+        sha256 = _hash_file(stix_file)
+        if table.get("sha256") != sha256:
+            table = None
+    else:
+        sha256 = _hash_file(stix_file)
+        table = None
+
+    metrics.cache("actor_table", int(table is not None), int(table is None))
+    if table is None:
+        metrics.count("stix_bytes_parsed", st.st_size)
+        table = compile_actor_table(stix_file)
+        table["sha256"] = sha256
+    table["size"] = st.st_size
+    table["mtime_ns"] = st.st_mtime_ns
+    try:
+        tmp_path = table_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(table, f, separators=(",", ":"))
+        os.replace(tmp_path, table_path)
+    except OSError as e:
+        print(f"Warning: failed to write actor table {table_path}: {e}")
+    return table
 
 def get_group_stix_id_by_name(stix_file, group_name):
     """
-    Load the local STIX file and return the STIX ID of the specified threat actor (intrusion-set object).
+    Return the STIX ID of the threat actor (intrusion-set object) with the given name or alias.
     """
     try:
-        with open(stix_file, "r", encoding="utf-8") as f:
-            bundle = json.load(f)
+        table = load_actor_table(stix_file)
     except Exception as e:
         print(f"Error: Failed to read STIX file: {e}")
         return None
+    return table["names"].get(group_name.lower())
 
-    for obj in bundle.get("objects", []):
-        if obj.get("type") == "intrusion-set" and obj.get("name", "").lower() == group_name.lower():
-            return obj.get("id")
-    return None
-
-def get_attack_ids_by_threat_actor(stix_file, threat_actor_name):
+def get_attack_ids_by_threat_actor(stix_file, threat_actor_name, table=None):
     """
-    From the specified threat actor name, obtain the STIX ID and use MitreAttackData to return a list of
-    ATT&CK technique IDs (e.g., t1190) used by the group.
+    From the specified threat actor name, return a list of ATT&CK technique IDs
+    (e.g., t1190) used by the group, resolved through the compiled actor table
+    (loaded from stix_file unless an already loaded table is given).
     """
-    group_stix_id = get_group_stix_id_by_name(stix_file, threat_actor_name)
+    if table is None:
+        try:
+            table = load_actor_table(stix_file)
+        except Exception as e:
+            print(f"Error: Failed to read STIX file: {e}")
+            return None
+    group_stix_id = table["names"].get(threat_actor_name.lower())
     if group_stix_id is None:
         print(f"Threat actor '{threat_actor_name}' not found in the STIX data.")
         return None
-    mitre_attack_data = MitreAttackData(stix_file)
-    techniques_used = mitre_attack_data.get_techniques_used_by_group(group_stix_id)
+    techniques_used = table["groups"][group_stix_id]["techniques"]
     attack_ids = []
     print(f"{threat_actor_name} uses {len(techniques_used)} technique(s):")
-    for t in techniques_used:
-        technique = t["object"]
-        attack_id = mitre_attack_data.get_attack_id(technique.id)
+    for attack_id in techniques_used:
         attack_ids.append(attack_id.lower())
-        print(f"* {technique.name} ({attack_id})")
+        print(f"* {table['techniques'][attack_id]} ({attack_id})")
     return attack_ids
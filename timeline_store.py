@@ -0,0 +1,262 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+STORE_VERSION = 1
+
+# Entries of the sorted (host, time) runs written per chunk and merged into the host index.
+RUN_DTYPE = np.dtype([("host", np.int32), ("time", np.int64), ("row", np.int64)])
+# Entries held in memory at once while merging the runs.
+MERGE_BUFFER_ROWS = 1_000_000
+
+# hayabusa csv-timeline column -> store column. Everything except the timestamp is
+# dictionary-encoded: each distinct value is stored once and rows hold int32 codes.
+CATEGORICAL_COLUMNS = {
+    "Computer": "computer",
+    "RuleTitle": "rule_title",
+    "Level": "level",
+    "Channel": "channel",
+    "EventID": "event_id",
+    "MitreTactics": "tactics",
+    "MitreTags": "techniques",
+    "RuleFile": "rule_file",
+}
+
+def _parse_timestamps(values):
+    """
+    Convert hayabusa timestamps to int64 nanoseconds since the epoch (UTC).
+    """
+    parsed = pd.to_datetime(values, format="%Y-%m-%d %H:%M:%S.%f %z", errors="coerce", utc=True)
+    if parsed.isna().any():
+        fallback = pd.to_datetime(values[parsed.isna()], format="mixed", errors="coerce", utc=True)
+        parsed = parsed.where(parsed.notna(), fallback)
+    ns = parsed.astype("int64").to_numpy()
+    # Unparseable timestamps (NaT) sort last
+    ns[parsed.isna().to_numpy()] = np.iinfo(np.int64).max
+    return ns
+
+def _to_ns(value):
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize("UTC")
+    return timestamp.value
+
+def _count_up_to(block, key):
+    """
+    Return how many entries of a block sorted by (host, time, row) are <= key.
+    """
+    host, time, row = key
+    lo = np.searchsorted(block["host"], host, side="left")
+    hi = np.searchsorted(block["host"], host, side="right")
+    if lo == hi:
+        return lo
+    times = block["time"][lo:hi]
+    t_lo = lo + np.searchsorted(times, time, side="left")
+    t_hi = lo + np.searchsorted(times, time, side="right")
+    if t_lo == t_hi:
+        return t_lo
+    return t_lo + np.searchsorted(block["row"][t_lo:t_hi], row, side="right")
+
+def _merge_runs(runs_path, run_bounds, order_path):
+    """
+    Merge the sorted runs stored back to back in runs_path ([(start, end)] entries) into
+    the row order written to order_path. Each round takes a block from every run, emits
+    the entries up to the smallest block end and keeps the rest, so at most about
+    MERGE_BUFFER_ROWS entries are in memory.
+    """
+    runs = np.memmap(runs_path, dtype=RUN_DTYPE, mode="r")
+    block_rows = max(1024, MERGE_BUFFER_ROWS // len(run_bounds))
+    positions = [start for start, end in run_bounds]
+    with open(order_path, "wb") as out:
+        while True:
+            blocks = [(i, runs[positions[i]:min(positions[i] + block_rows, end)])
+                      for i, (start, end) in enumerate(run_bounds) if positions[i] < end]
+            if not blocks:
+                break
+            cutoff = min((int(block["host"][-1]), int(block["time"][-1]), int(block["row"][-1])) for i, block in blocks)
+            parts = []
+            for i, block in blocks:
+                count = _count_up_to(block, cutoff)
+                if count:
+                    parts.append(block[:count])
+                    positions[i] += count
+            merged = np.concatenate(parts)
+            if len(parts) > 1:
+                merged = merged[np.lexsort((merged["row"], merged["time"], merged["host"]))]
+            merged["row"].astype(np.int64).tofile(out)
+
+def ingest_timeline(csv_path, store_dir, chunksize=100_000):
+    """
+    Stream a hayabusa CSV timeline into a columnar store at store_dir.
+
+    The CSV is read chunksize rows at a time, so memory stays bounded by the chunk size
+    plus the dictionaries of distinct values. Timestamps are stored as int64 nanoseconds;
+    computer, rule title, level, channel, event ID, tactics, techniques and rule file are
+    dictionary-encoded as int32 codes. Each chunk's rows are also written as a run sorted
+    by (host, time), and the runs are merged k-way into the (host, time) index, so building
+    the index needs memory for about MERGE_BUFFER_ROWS entries rather than for every row.
+    Returns the number of rows ingested.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    header = pd.read_csv(csv_path, nrows=0).columns
+    columns = {src: dst for src, dst in CATEGORICAL_COLUMNS.items() if src in header}
+    usecols = ["Timestamp"] + list(columns)
+
+    dictionaries = {dst: {} for dst in columns.values()}
+    outputs = {dst: open(os.path.join(store_dir, f"{dst}.i4"), "wb") for dst in columns.values()}
+    outputs["timestamp"] = open(os.path.join(store_dir, "timestamp.i8"), "wb")
+    runs_path = os.path.join(store_dir, "host_time_runs.tmp")
+    if "computer" in dictionaries:
+        outputs["runs"] = open(runs_path, "wb")
+    run_bounds = []
+    host_counts = np.zeros(0, dtype=np.int64)
+    rows = 0
+    try:
+        reader = pd.read_csv(
+            csv_path, usecols=usecols, dtype=str, keep_default_na=False, chunksize=chunksize
+        )
+        for chunk in reader:
+            times = _parse_timestamps(chunk["Timestamp"])
+            times.tofile(outputs["timestamp"])
+            for src, dst in columns.items():
+                dictionary = dictionaries[dst]
+                uniques, inverse = np.unique(chunk[src].to_numpy(dtype=object), return_inverse=True)
+                mapping = np.array(
+                    [dictionary.setdefault(value, len(dictionary)) for value in uniques], dtype=np.int32
+                )
+                codes = mapping[inverse].astype(np.int32)
+                codes.tofile(outputs[dst])
+                if dst == "computer":
+                    run = np.empty(len(chunk), dtype=RUN_DTYPE)
+                    run["host"], run["time"], run["row"] = codes, times, np.arange(rows, rows + len(chunk))
+                    run[np.lexsort((times, codes))].tofile(outputs["runs"])
+                    run_bounds.append((rows, rows + len(chunk)))
+                    counts = np.bincount(codes, minlength=len(dictionary))
+                    counts[:len(host_counts)] += host_counts
+                    host_counts = counts
+            rows += len(chunk)
+    finally:
+        for output in outputs.values():
+            output.close()
+
+    for dst, dictionary in dictionaries.items():
+        with open(os.path.join(store_dir, f"{dst}.dict.json"), "w", encoding="utf-8") as f:
+            json.dump(list(dictionary), f)
+
+    # Index by host and time: row order sorted by (computer, timestamp) plus per-host offsets
+    if "computer" in dictionaries:
+        if rows:
+            _merge_runs(runs_path, run_bounds, os.path.join(store_dir, "host_time_order.i8"))
+            offsets = np.concatenate(([0], np.cumsum(host_counts)))
+            np.save(os.path.join(store_dir, "host_offsets.npy"), offsets.astype(np.int64))
+        os.remove(runs_path)
+
+    with open(os.path.join(store_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"version": STORE_VERSION, "rows": rows, "columns": ["timestamp"] + list(columns.values())}, f)
+    return rows
+
+class TimelineStore:
+    """
+    Read-only access to a store written by ingest_timeline. Columns are memory-mapped,
+    so queries only touch the columns (and, for per-host queries, the rows) they need.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != STORE_VERSION:
+            raise ValueError(f"Unsupported timeline store version in {store_dir}")
+        self.rows = self.meta["rows"]
+        self._dictionaries = {}
+
+    def dictionary(self, column):
+        """
+        Return the list of distinct values of a dictionary-encoded column, indexed by code.
+        """
+        if column not in self._dictionaries:
+            with open(os.path.join(self.store_dir, f"{column}.dict.json"), "r", encoding="utf-8") as f:
+                self._dictionaries[column] = json.load(f)
+        return self._dictionaries[column]
+
+    def codes(self, column):
+        """
+        Return the memory-mapped int32 codes of a dictionary-encoded column.
+        """
+        if not self.rows:
+            return np.zeros(0, dtype=np.int32)
+        return np.memmap(os.path.join(self.store_dir, f"{column}.i4"), dtype=np.int32, mode="r")
+
+    def timestamps(self):
+        """
+        Return the memory-mapped int64 timestamps (nanoseconds since the epoch, UTC).
+        """
+        if not self.rows:
+            return np.zeros(0, dtype=np.int64)
+        return np.memmap(os.path.join(self.store_dir, "timestamp.i8"), dtype=np.int64, mode="r")
+
+    def value_counts(self, column, top=None):
+        """
+        Return [(value, count)] for a dictionary-encoded column, most frequent first
+        (ties by value).
+        """
+        values = self.dictionary(column)
+        counts = np.bincount(self.codes(column), minlength=len(values))
+        ranked = sorted(((values[i], int(count)) for i, count in enumerate(counts) if count),
+                        key=lambda item: (-item[1], item[0]))
+        return ranked[:top] if top is not None else ranked
+
+    def host_counts(self):
+        """
+        Return {host: detection count}, read from the host index without scanning rows.
+        """
+        offsets = np.load(os.path.join(self.store_dir, "host_offsets.npy"))
+        hosts = self.dictionary("computer")
+        return {host: int(offsets[i + 1] - offsets[i]) for i, host in enumerate(hosts)}
+
+    def top_rules(self, top=10):
+        """
+        Return the top rule titles by detection count.
+        """
+        return self.value_counts("rule_title", top)
+
+    def host_events(self, host, start=None, end=None):
+        """
+        Return a DataFrame of a host's detections in time order, optionally limited to
+        [start, end) (anything pandas.Timestamp accepts; naive values are UTC).
+        """
+        hosts = self.dictionary("computer")
+        if host not in hosts:
+            return pd.DataFrame(columns=self.meta["columns"])
+        code = hosts.index(host)
+        offsets = np.load(os.path.join(self.store_dir, "host_offsets.npy"))
+        order = np.memmap(os.path.join(self.store_dir, "host_time_order.i8"), dtype=np.int64, mode="r")
+        rows = np.asarray(order[offsets[code]:offsets[code + 1]])
+        times = self.timestamps()[rows]
+        lo, hi = 0, len(rows)
+        if start is not None:
+            lo = np.searchsorted(times, _to_ns(start), side="left")
+        if end is not None:
+            hi = np.searchsorted(times, _to_ns(end), side="left")
+        rows, times = rows[lo:hi], times[lo:hi]
+        frame = {"timestamp": pd.to_datetime(times, utc=True)}
+        for column in self.meta["columns"][1:]:
+            frame[column] = pd.Categorical.from_codes(self.codes(column)[rows], self.dictionary(column))
+        return pd.DataFrame(frame)
+
+def print_store_summary(store_dir, top=10):
+    """
+    Print per-host detection counts and the most frequent rules from a timeline store.
+    """
+    store = TimelineStore(store_dir)
+    print(f"\nTimeline store: {store.rows} detection(s) in {store_dir}\n")
+    if not store.rows:
+        return
+    print("Detections per host:")
+    for host, count in sorted(store.host_counts().items(), key=lambda item: -item[1]):
+        print(f"{host}: {count}")
+    print(f"\nTop {top} rules:")
+    for title, count in store.top_rules(top):
+        print(f"{title}: {count}")
+    print()
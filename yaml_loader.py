@@ -0,0 +1,61 @@
+import os
+import yaml
+from concurrent.futures import ProcessPoolExecutor
+
+# libyaml's C loader is several times faster than the pure-Python one; fall back when
+# PyYAML was built without it.
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Below this many files the cost of starting worker processes outweighs the parsing work.
+MIN_PARALLEL_FILES = 64
+
+def load_yaml_file(file_path):
+    """
+    Parse a single YAML file with the fastest available safe loader.
+    """
+    with open(file_path, "r", encoding="utf-8") as f:
+        return yaml.load(f, Loader=SafeLoader)
+
+def _load_one(job):
+    file_path, transform = job
+    try:
+        data = load_yaml_file(file_path)
+        if transform is not None:
+            data = transform(data)
+    except Exception as e:
+        return None, str(e)
+    return data, None
+
+def resolve_workers(workers=None):
+    """
+    Return the worker count to use; None or values below 1 mean one per CPU.
+    """
+    if workers is None or workers < 1:
+        return os.cpu_count() or 1
+    return workers
+
+def load_yaml_files(file_paths, workers=None, transform=None):
+    """
+    Parse many YAML files, fanning out across a process pool.
+
+    Yields (file_path, data, error) in the same order as file_paths. When transform is
+    given (it must be a module-level function so it can be sent to workers), it is applied
+    to each parsed document inside the worker and its result is returned instead, which
+    keeps large documents from being shipped back to the parent. error is None on success
+    and a message otherwise.
+    """
+    file_paths = list(file_paths)
+    workers = min(resolve_workers(workers), max(len(file_paths), 1))
+    jobs = [(file_path, transform) for file_path in file_paths]
+
+    if workers == 1 or len(file_paths) < MIN_PARALLEL_FILES:
+        results = map(_load_one, jobs)
+        for file_path, (data, error) in zip(file_paths, results):
+            yield file_path, data, error
+        return
+
+    chunksize = max(1, len(jobs) // (workers * 8))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_load_one, jobs, chunksize=chunksize)
+        for file_path, (data, error) in zip(file_paths, results):
+            yield file_path, data, error